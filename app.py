@@ -5,352 +5,3236 @@ import time
 import signal
 import requests
 import hashlib
-from flask import Flask, render_template, send_from_directory, abort, request, redirect, url_for, flash, jsonify
+import json
+import shutil
+import itertools
+import math
+import struct
+import sqlite3
+import re
+import bisect
+import uuid
+import ctypes
+import errno
+from datetime import datetime, timezone
+from flask import Flask, render_template, send_from_directory, send_file, abort, request, redirect, url_for, flash, jsonify, stream_with_context
 from flask_cors import CORS
-from collections import deque
+from collections import deque, OrderedDict
 import traceback
-from urllib.parse import urlparse, urlunparse, parse_qs, urlencode
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
 
-DEFAULT_VIDEO_URL = "https://www.dropbox.com/scl/fi/2w5ai1fda804zfruoj8yn/assets_staytuned0.ts?rlkey=jixrs4b1v3keu4q6hpebmbw5v&st=b1teebao&raw=1"
-DEFAULT_VIDEO_FILENAME = "default_video.ts"
+DEFAULT_VIDEO_URL = os.environ.get('DEFAULT_VIDEO_URL', "https://www.dropbox.com/scl/fi/2w5ai1fda804zfruoj8yn/assets_staytuned0.ts?rlkey=jixrs4b1v3keu4q6hpebmbw5v&st=b1teebao&raw=1")
 
 VIDEO_DIR = "videos"
 STREAM_OUTPUT_DIR = "stream_output"
-HLS_OUTPUT_FILE = os.path.join(STREAM_OUTPUT_DIR, "stream.m3u8")
+HLS_OUTPUT_NAME = "stream.m3u8"
+LIVE_DIR_NAME = "live"
+# Published segments are hard-linked here so they outlive ffmpeg's own cleanup.
+STORE_DIR_NAME = "store"
+
+DROPBOX_HOSTS = ('www.dropbox.com', 'dropbox.com')
+DROPBOX_VOLATILE_PARAMS = ('st', 'dl', 'raw')
+# Distinct URL strings whose canonical form and cache filename are remembered.
+URL_KEY_CACHE_SIZE = int(os.environ.get('URL_KEY_CACHE_SIZE', '4096'))
+
+
+def env_flag(name, default):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() not in ('0', 'false', 'no', 'off', '')
+
+
+# HLS_MODE=ts is the classic MPEG-TS output; HLS_MODE=ll publishes LL-HLS
+# (fMP4 parts, EXT-X-PART, preload hints and blocking playlist reload).
+HLS_MODE = os.environ.get('HLS_MODE', 'ts').strip().lower()
+LOW_LATENCY = HLS_MODE == 'll'
+HLS_TIME = int(os.environ.get('HLS_TIME', '2' if LOW_LATENCY else '4'))
+HLS_LIST_SIZE = int(os.environ.get('HLS_LIST_SIZE', '6'))
+LL_PART_TARGET = float(os.environ.get('LL_PART_TARGET', '0.5'))
+# Parts are listed for this many trailing segments, as the spec recommends.
+LL_PARTS_WINDOW = 3
+BLOCKING_RELOAD_TIMEOUT = HLS_TIME * 3
+
+# Gapless mode warms up the next item's ffmpeg before the current one ends and
+# keeps the public playlist running across items with EXT-X-DISCONTINUITY.
+GAPLESS_TRANSITIONS = env_flag('GAPLESS_TRANSITIONS', True)
+PRESPAWN_LEAD_SECONDS = float(os.environ.get('PRESPAWN_LEAD_SECONDS', '8'))
+PUBLISH_SLACK_SECONDS = 0.25
+# Scheduled items are prefetched this far ahead of their start time.
+SCHEDULE_PREFETCH_SECONDS = float(os.environ.get('SCHEDULE_PREFETCH_SECONDS', '1800'))
+# A start this far in the past still joins in progress; older ones are refused.
+SCHEDULE_MAX_PAST_SECONDS = float(os.environ.get('SCHEDULE_MAX_PAST_SECONDS', '3600'))
+# How often a staged playlist is re-checked while a segment is overdue.
+SEGMENT_POLL_SECONDS = 0.25
+IDLE_WAIT_SECONDS = 5
+# Staged segments must outlive the pre-spawn backlog plus the public window
+# plus the retired window that late clients may still fetch from.
+# In LL mode ffmpeg's own "segments" are the short parts.
+STAGING_UNIT_SECONDS = LL_PART_TARGET if LOW_LATENCY else HLS_TIME
+STAGING_LIST_SIZE = int(math.ceil(HLS_LIST_SIZE * HLS_TIME / STAGING_UNIT_SECONDS))
+STAGING_DELETE_THRESHOLD = int(math.ceil((HLS_LIST_SIZE * 2 * HLS_TIME + PRESPAWN_LEAD_SECONDS) / STAGING_UNIT_SECONDS)) + 2
+
+PREFETCH_WORKERS = int(os.environ.get('PREFETCH_WORKERS', '2'))
+PREFETCH_DEPTH = max(1, int(os.environ.get('PREFETCH_DEPTH', '3')))
+# Bytes per second shared by all prefetch workers; 0 disables the cap.
+PREFETCH_RATE_LIMIT = int(os.environ.get('PREFETCH_RATE_LIMIT', '0'))
+PREFETCH_RETRY_SECONDS = 30
+DOWNLOAD_HISTORY_SIZE = 50
+# Transient failures (dropped connections, timeouts, 5xx) are retried with
+# exponential backoff, each attempt resuming the .part file with Range.
+DOWNLOAD_RETRIES = int(os.environ.get('DOWNLOAD_RETRIES', '5'))
+DOWNLOAD_RETRY_DELAY = float(os.environ.get('DOWNLOAD_RETRY_DELAY', '1'))
+DOWNLOAD_RETRY_MAX_DELAY = 30
+DOWNLOAD_RETRY_STATUSES = (408, 425, 429, 500, 502, 503, 504)
+DOWNLOAD_CHUNK_BYTES = 1024 * 1024
+DOWNLOAD_TIMEOUT = (10, 60)
+HTTP_USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+
+VIDEO_CACHE_BUDGET_BYTES = int(float(os.environ.get('VIDEO_CACHE_BUDGET_MB', '10240')) * 1024 * 1024)
+VIDEO_CACHE_POLICY = os.environ.get('VIDEO_CACHE_POLICY', 'lru').lower()
+
+# Cached files are normalised once at ingest (AAC 44.1 kHz stereo, H.264 with
+# keyframes on the segment grid) so live playback is a pure stream copy.
+INGEST_ENABLED = env_flag('INGEST_ENABLED', True)
+INGEST_WORKERS = max(1, int(os.environ.get('INGEST_WORKERS', '1')))
+INGEST_PRESET = os.environ.get('INGEST_PRESET', 'veryfast')
+INGEST_CRF = int(os.environ.get('INGEST_CRF', '20'))
+INGEST_MAX_KEYFRAME_INTERVAL = HLS_TIME * 1.5
+# How long a pre-spawn holds off for a running ingest before playing the raw file.
+INGEST_MAX_WAIT_SECONDS = float(os.environ.get('INGEST_MAX_WAIT_SECONDS', '30'))
+
+# The default video is cut into HLS segments once and then looped by replaying
+# those segments, so an idle channel runs no ffmpeg at all.
+PRESEGMENTED_FILLER = env_flag('PRESEGMENTED_FILLER', True)
+FILLER_DIR = os.path.join(VIDEO_DIR, 'filler')
+FILLER_LEAD_SECONDS = HLS_TIME * 2
+
+# Items that are not cached yet start straight from their HTTP source while
+# the prefetch keeps filling the cache; a source that yields no segment in
+# time falls back to the full download.
+PROGRESSIVE_START = env_flag('PROGRESSIVE_START', True)
+PROGRESSIVE_START_TIMEOUT = float(os.environ.get('PROGRESSIVE_START_TIMEOUT', '15'))
+# After a failed progressive start the URL waits for its download, for this long.
+PROGRESSIVE_RETRY_SECONDS = float(os.environ.get('PROGRESSIVE_RETRY_SECONDS', '600'))
+STARTUP_HISTORY_SIZE = 50
+
+# Each pipeline's ffmpeg reports -progress on stdout and keeps its recent
+# stderr. One that stops producing segments, or dies on its own, is
+# restarted where it left off with exponential backoff between attempts.
+FFMPEG_STALL_SECONDS = float(os.environ.get('FFMPEG_STALL_SECONDS', str(max(20, HLS_TIME * 4))))
+FFMPEG_MAX_RESTARTS = int(os.environ.get('FFMPEG_MAX_RESTARTS', '5'))
+FFMPEG_RESTART_DELAY = float(os.environ.get('FFMPEG_RESTART_DELAY', '1'))
+FFMPEG_RESTART_MAX_DELAY = 30
+# A pipeline that produced this much media before failing starts the count over.
+FFMPEG_HEALTHY_SECONDS = 60
+FFMPEG_STDERR_LINES = int(os.environ.get('FFMPEG_STDERR_LINES', '50'))
+SEGMENT_LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 5, 10)
+
+# Adaptive bitrate ladder, e.g. ABR_LADDER=source,720p,480p,360p. Empty keeps
+# the single copy rendition. Transcodes are (height, video kbps, audio kbps).
+ABR_RENDITIONS = {
+    'source': None,
+    '1080p': (1080, 5000, 128),
+    '720p': (720, 2800, 128),
+    '480p': (480, 1400, 96),
+    '360p': (360, 800, 96),
+}
+ABR_LADDER = [name.strip() for name in os.environ.get('ABR_LADDER', '').split(',') if name.strip() in ABR_RENDITIONS]
+ABR_PRESET = os.environ.get('ABR_PRESET', 'veryfast')
+# /abr/cost answers from its last measurement for this long.
+ABR_COST_CACHE_SECONDS = float(os.environ.get('ABR_COST_CACHE_SECONDS', '300'))
+STREAM_VARIANTS = ABR_LADDER or ['main']
+
+# Push targets get the same encode as the HLS output through ffmpeg's tee
+# muxer, e.g. PUSH_TARGETS="rtmp://live.example.com/app/KEY udp://239.0.0.1:1234"
+# for the main channel. A failed target is dropped for the rest of that ffmpeg
+# run and reported while the HLS output carries on; the next item reconnects it.
+# An ingest accepts one publisher at a time, so channels with push targets
+# switch items back to back instead of pre-spawning the next one.
+PUSH_FORMATS = {'rtmp': 'flv', 'rtmps': 'flv', 'srt': 'mpegts', 'udp': 'mpegts'}
+PUSH_TARGETS = os.environ.get('PUSH_TARGETS', '').split()
+# Packets a slow target may fall behind before it is failed.
+PUSH_QUEUE_SIZE = int(os.environ.get('PUSH_QUEUE_SIZE', '600'))
+TEE_SLAVE_FAILED = re.compile(r'Slave muxer #(\d+) failed: (.*?), continuing with')
+
+PLAYLIST_MAX_AGE = int(os.environ.get('PLAYLIST_MAX_AGE', '1'))
+SEGMENT_MAX_AGE = int(os.environ.get('SEGMENT_MAX_AGE', '86400'))
+# Published .ts segments are served from their staged file instead of memory,
+# so the WSGI server can hand them to sendfile().
+SEGMENT_SENDFILE = env_flag('SEGMENT_SENDFILE', True)
+
+DATA_DIR = os.environ.get('DATA_DIR', 'data')
+QUEUE_DB_PATH = os.path.join(DATA_DIR, 'queue.db')
+# Queue writes are grouped into one transaction per interval, so a burst of
+# enqueues costs one commit rather than one per URL.
+QUEUE_COMMIT_INTERVAL = float(os.environ.get('QUEUE_COMMIT_INTERVAL', '0.05'))
+QUEUE_BATCH_LIMIT = int(os.environ.get('QUEUE_BATCH_LIMIT', '10000'))
+# Held by the one process that runs the stream supervisor on this node.
+SUPERVISOR_LOCK_PATH = os.path.join(DATA_DIR, 'supervisor.lock')
+
+EVENT_HISTORY_SIZE = 1000
+DOWNLOAD_EVENT_INTERVAL = 1.0
+SSE_KEEPALIVE_SECONDS = 15
+SSE_RETRY_SECONDS = 3
+SSE_SNAPSHOT_QUEUE_LIMIT = 100
+
+# The main channel serves /stream/ as before; extra channels get their own
+# queue, default video and output under /stream/<name>/ and share the cache.
+MAIN_CHANNEL = 'main'
+CHANNELS_FILE = os.path.join(DATA_DIR, 'channels.json')
+CHANNEL_DATA_DIR = os.path.join(DATA_DIR, 'channels')
+MAX_CHANNELS = int(os.environ.get('MAX_CHANNELS', '32'))
+CHANNEL_NAME_PATTERN = re.compile(r'^[a-z0-9][a-z0-9_-]{0,31}$')
 
-video_queue = deque()
-played_today = set()
-current_ffmpeg_process = None
 stop_event = threading.Event()
-stream_lock = threading.Lock()
-currently_playing_url = None
-default_video_path = None
+url_keys = OrderedDict()
+url_keys_lock = threading.Lock()
+filler_lock = threading.Lock()
+services_lock = threading.Lock()
+services_started = False
+supervisor_lock_file = None
+channels = {}
+channels_lock = threading.Lock()
+pipeline_ids = itertools.count(1)
+progressive_failed = {}
+abr_cost_lock = threading.Lock()
+abr_cost_last = None
+startup_history = deque(maxlen=STARTUP_HISTORY_SIZE)
+# Segment URLs are cached as immutable, so they must never repeat across restarts.
+RUN_ID = format(int(time.time()), 'x')
+
+app = Flask(__name__)
+CORS(app)
+app.secret_key = os.urandom(24)
+
+os.makedirs(VIDEO_DIR, exist_ok=True)
+os.makedirs(STREAM_OUTPUT_DIR, exist_ok=True)
+os.makedirs(DATA_DIR, exist_ok=True)
+os.makedirs(CHANNEL_DATA_DIR, exist_ok=True)
+
+def notify_scheduler():
+    for channel in list(channels.values()):
+        channel.notify()
+
+
+def normalize_url(url):
+    # Scheme and host are case-insensitive and the fragment never reaches the
+    # server. Dropbox share links also drop the params that differ between
+    # copies of the same link (st, dl) and always ask for the raw file.
+    try:
+        if not url or not (url.startswith('http://') or url.startswith('https://')):
+            return url
+        parsed_url = urlparse(url)
+        scheme = parsed_url.scheme.lower()
+        userinfo, at, host = parsed_url.netloc.rpartition('@')
+        host = host.lower()
+        if (scheme, parsed_url.port) in (('http', 80), ('https', 443)):
+            host = host.rsplit(':', 1)[0]
+        query = parsed_url.query
+        if host in DROPBOX_HOSTS:
+            params = [(k, v) for k, v in parse_qsl(query, keep_blank_values=True) if k not in DROPBOX_VOLATILE_PARAMS]
+            query = urlencode(sorted(params) + [('raw', '1')])
+        return urlunparse((scheme, f"{userinfo}{at}{host}", parsed_url.path, parsed_url.params, query, ''))
+    except Exception as e:
+        return url
+
+
+def safe_filename(url):
+    try:
+        parsed_url = urlparse(url)
+        path_part = parsed_url.path
+        base_name = os.path.basename(path_part)
+        _, ext = os.path.splitext(base_name)
+
+        hashed_url = hashlib.sha1(url.encode()).hexdigest()[:10]
+
+        if not ext or len(ext) > 5:
+             ext = '.mp4'
+
+        if ext.lower() not in ['.mp4', '.ts', '.mkv', '.avi', '.mov', '.wmv', '.flv', '.m3u8']:
+             ext = '.mp4'
+
+        return f"video_{hashed_url}{ext}"
+    except Exception as e:
+        # Error logging removed as requested
+        hashed_url = hashlib.sha1(url.encode()).hexdigest()[:10]
+        return f"video_{hashed_url}.mp4"
+
+
+def url_key(url):
+    # (canonical URL, cache filename), parsed once per distinct string. Both
+    # the original and the canonical form are remembered, so anything that
+    # only ever sees canonical URLs (the queue, the scheduler) never parses.
+    with url_keys_lock:
+        key = url_keys.get(url)
+        if key is not None:
+            url_keys.move_to_end(url)
+            return key
+    canonical = normalize_url(url)
+    key = (canonical, safe_filename(canonical))
+    with url_keys_lock:
+        url_keys[url] = key
+        url_keys[canonical] = key
+        while len(url_keys) > URL_KEY_CACHE_SIZE:
+            url_keys.popitem(last=False)
+    return key
+
+
+def canonical_url(url):
+    return url_key(url)[0]
+
+
+def get_safe_filename(url):
+    return url_key(url)[1]
+
+
+def parse_content_range_total(content_range):
+    try:
+        total = content_range.rsplit('/', 1)[1]
+        return int(total) if total != '*' else None
+    except (IndexError, ValueError):
+        return None
+
+
+def parse_content_range_start(content_range):
+    try:
+        return int(content_range.split()[1].split('-', 1)[0])
+    except (IndexError, ValueError):
+        return None
+
+
+def make_http_session():
+    # Shared by every download so connections to the same host are reused.
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=max(4, PREFETCH_WORKERS * 2))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['User-Agent'] = HTTP_USER_AGENT
+    # Byte counts, Content-Length checks and Range resumes all assume the body
+    # arrives exactly as stored, so no transfer compression.
+    session.headers['Accept-Encoding'] = 'identity'
+    return session
+
+
+http_session = make_http_session()
+
+try:
+    libc_fallocate = ctypes.CDLL(None, use_errno=True).fallocate
+    libc_fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+except (OSError, AttributeError):
+    libc_fallocate = None
+FALLOC_FL_KEEP_SIZE = 1
+
+
+def preallocate(f, offset, length):
+    # Reserves the blocks without changing the file size, so a resumed
+    # download still starts from what was really written. Only a full disk
+    # is an error; filesystems without fallocate just skip it.
+    if libc_fallocate is None or length <= 0:
+        return
+    if libc_fallocate(f.fileno(), FALLOC_FL_KEEP_SIZE, offset, length) != 0:
+        err = ctypes.get_errno()
+        if err == errno.ENOSPC:
+            raise OSError(err, os.strerror(err))
+
+
+def download_attempt(url, part_path, progress, rate_limiter):
+    # One request, resuming whatever the .part file already holds. Returns
+    # the SHA-256 of the finished file, False to retry, or None to give up.
+    resume_from = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {'Range': f'bytes={resume_from}-'} if resume_from else {}
+    try:
+        with http_session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT, headers=headers, allow_redirects=True) as response:
+            if response.status_code == 416:
+                # The partial file no longer matches the source; start over.
+                os.remove(part_path)
+                return False
+            if response.status_code in DOWNLOAD_RETRY_STATUSES:
+                return False
+            response.raise_for_status()
+
+            content_range = response.headers.get('content-range', '')
+            if response.status_code == 206:
+                if parse_content_range_start(content_range) != resume_from:
+                    # Not the range that was asked for; the next attempt
+                    # starts over without one.
+                    if os.path.exists(part_path):
+                        os.remove(part_path)
+                    return False
+                total_size = parse_content_range_total(content_range)
+                mode = 'ab'
+            else:
+                content_length = response.headers.get('content-length')
+                total_size = int(content_length) if content_length and content_length.isdigit() else None
+                resume_from = 0
+                mode = 'wb'
+
+            digest = hashlib.sha256()
+            if resume_from:
+                with open(part_path, 'rb') as f:
+                    for block in iter(lambda: f.read(DOWNLOAD_CHUNK_BYTES), b''):
+                        digest.update(block)
+
+            downloaded_size = resume_from
+            if progress:
+                progress(downloaded_size, total_size)
+
+            with open(part_path, mode) as f:
+                if total_size:
+                    preallocate(f, resume_from, total_size - resume_from)
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_BYTES):
+                    if stop_event.is_set():
+                        return None
+                    if rate_limiter:
+                        rate_limiter.consume(len(chunk))
+                    f.write(chunk)
+                    digest.update(chunk)
+                    downloaded_size += len(chunk)
+                    if progress:
+                        progress(downloaded_size, total_size)
+
+        if downloaded_size == 0:
+            os.remove(part_path)
+            return None
+        if total_size is not None and downloaded_size != total_size:
+            # A short read resumes; anything longer is corrupt and starts over.
+            if downloaded_size > total_size:
+                os.remove(part_path)
+            return False
+        return digest.hexdigest()
+
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+        return False
+    except requests.exceptions.RequestException as e:
+        return None
+    except OSError as e:
+        return None
+
+
+def download_video(url, output_filename, progress=None, rate_limiter=None, on_retry=None):
+    # Returns (path, sha256). The digest is None for a file that was already
+    # on disk; the .part file is kept on failure so the next call resumes.
+    filepath = os.path.join(VIDEO_DIR, output_filename)
+    part_path = filepath + '.part'
+    try:
+        if os.path.getsize(filepath) > 0:
+            return filepath, None
+    except OSError as e:
+        pass
+
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        if attempt:
+            if on_retry:
+                on_retry(attempt)
+            if stop_event.wait(min(DOWNLOAD_RETRY_MAX_DELAY, DOWNLOAD_RETRY_DELAY * 2 ** (attempt - 1))):
+                return None, None
+        digest = download_attempt(url, part_path, progress, rate_limiter)
+        if digest is None:
+            return None, None
+        if digest:
+            try:
+                os.replace(part_path, filepath)
+            except OSError as e:
+                return None, None
+            return filepath, digest
+    return None, None
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        with self.lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+
+    def samples(self, labels):
+        with self.lock:
+            samples = [('_bucket', dict(labels, le=str(bound)), count) for bound, count in zip(self.buckets, self.counts)]
+            samples.append(('_bucket', dict(labels, le='+Inf'), self.count))
+            samples.append(('_sum', labels, round(self.sum, 6)))
+            samples.append(('_count', labels, self.count))
+        return samples
+
+
+class EventBus:
+    # One shared log with contiguous ids: publishing costs the same however
+    # many watchers there are, and each watcher just reads past its last id.
+    def __init__(self, history):
+        self.cond = threading.Condition()
+        self.events = deque(maxlen=history)
+        # Seeded from the clock so an id held over from a previous run always
+        # predates the log and forces a resync.
+        self.last_id = int(time.time() * 1000)
+
+    def publish(self, name, data):
+        with self.cond:
+            self.last_id += 1
+            self.events.append({'id': self.last_id, 'event': name, 'time': time.time(), 'data': data})
+            self.cond.notify_all()
+
+    def wake(self):
+        with self.cond:
+            self.cond.notify_all()
+
+    def since(self, last_id, timeout):
+        # Returns None unless last_id is the head or still in the log, so a
+        # stale or unknown id resyncs at once instead of waiting.
+        with self.cond:
+            if last_id == self.last_id:
+                self.cond.wait(timeout)
+                if last_id == self.last_id:
+                    return []
+            if last_id > self.last_id or not self.events:
+                return None
+            first_id = self.events[0]['id']
+            if last_id < first_id - 1:
+                return None
+            return list(itertools.islice(self.events, last_id - first_id + 1, None))
+
+
+event_bus = EventBus(EVENT_HISTORY_SIZE)
+
+
+class QueueJournal:
+    def __init__(self, path, commit_interval):
+        self.path = path
+        self.commit_interval = commit_interval
+        self.cond = threading.Condition()
+        self.ops = []
+        self.now_playing = None
+        self.resume = {}
+        self.schedule = []
+        self.thread = None
+        self.closed = threading.Event()
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(
+            'CREATE TABLE IF NOT EXISTS queue (url TEXT PRIMARY KEY, position INTEGER NOT NULL);'
+            'CREATE INDEX IF NOT EXISTS queue_position ON queue (position);'
+            'CREATE TABLE IF NOT EXISTS played (url TEXT PRIMARY KEY, played_at REAL NOT NULL);'
+            'CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT);'
+            'CREATE TABLE IF NOT EXISTS schedule (id TEXT PRIMARY KEY, url TEXT NOT NULL, start_at REAL NOT NULL);')
+        return conn
+
+    def load(self):
+        try:
+            conn = self.connect()
+        except sqlite3.Error as e:
+            return [], [], []
+        try:
+            queue = conn.execute('SELECT url, position FROM queue ORDER BY position').fetchall()
+            played = [row[0] for row in conn.execute('SELECT url FROM played ORDER BY played_at')]
+            row = conn.execute("SELECT value FROM state WHERE key = 'now_playing'").fetchone()
+            now_playing = json.loads(row[0]) if row else []
+            row = conn.execute("SELECT value FROM state WHERE key = 'resume'").fetchone()
+            resume = json.loads(row[0]) if row else {}
+            schedule = conn.execute('SELECT id, url, start_at FROM schedule ORDER BY start_at').fetchall()
+        except (sqlite3.Error, ValueError) as e:
+            return [], [], []
+        finally:
+            conn.close()
+        self.now_playing = now_playing
+        self.resume = resume
+        self.schedule = [{'id': entry_id, 'url': url, 'start_at': start_at} for entry_id, url, start_at in schedule]
+        return queue, played, now_playing
+
+    def record(self, *op):
+        with self.cond:
+            self.ops.append(op)
+            self.cond.notify()
+
+    def set_now_playing(self, urls):
+        if urls != self.now_playing:
+            self.now_playing = urls
+            self.record('state', 'now_playing', json.dumps(urls))
+
+    def set_resume(self, offsets):
+        if offsets != self.resume:
+            self.resume = offsets
+            self.record('state', 'resume', json.dumps(offsets))
+
+    def start(self):
+        self.thread = threading.Thread(target=self.writer, name="QueueJournal", daemon=True)
+        self.thread.start()
+
+    def writer(self):
+        try:
+            conn = self.connect()
+        except sqlite3.Error as e:
+            return
+        while self.is_active():
+            with self.cond:
+                while not self.ops and self.is_active():
+                    self.cond.wait(timeout=1)
+            # Let the rest of a burst land in the same transaction.
+            time.sleep(self.commit_interval)
+            self.flush(conn)
+        self.flush(conn)
+        conn.close()
+
+    def is_active(self):
+        return not stop_event.is_set() and not self.closed.is_set()
+
+    def flush(self, conn):
+        with self.cond:
+            ops, self.ops = self.ops, []
+        if not ops:
+            return
+        try:
+            with conn:
+                for op in ops:
+                    self.apply(conn, op)
+        except sqlite3.Error as e:
+            pass
+
+    def apply(self, conn, op):
+        kind = op[0]
+        if kind == 'add':
+            conn.execute('INSERT OR REPLACE INTO queue (url, position) VALUES (?, ?)', op[1:])
+        elif kind == 'remove':
+            conn.execute('DELETE FROM queue WHERE url = ?', op[1:])
+        elif kind == 'clear':
+            conn.execute('DELETE FROM queue')
+        elif kind == 'rewrite':
+            conn.execute('DELETE FROM queue')
+            conn.executemany('INSERT INTO queue (url, position) VALUES (?, ?)', op[1])
+        elif kind == 'played':
+            conn.execute('INSERT OR REPLACE INTO played (url, played_at) VALUES (?, ?)', op[1:])
+        elif kind == 'clear_played':
+            conn.execute('DELETE FROM played')
+        elif kind == 'state':
+            conn.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', op[1:])
+        elif kind == 'schedule_add':
+            conn.execute('INSERT OR REPLACE INTO schedule (id, url, start_at) VALUES (?, ?, ?)', op[1:])
+        elif kind == 'schedule_remove':
+            conn.execute('DELETE FROM schedule WHERE id = ?', op[1:])
+
+    def close(self):
+        self.closed.set()
+        if self.thread and self.thread.is_alive():
+            with self.cond:
+                self.cond.notify()
+            self.thread.join(timeout=5)
+
+
+class PersistentQueue:
+    # deque-like over an insertion-ordered dict: O(1) membership, append,
+    # popleft and remove, with every change journalled.
+    def __init__(self, journal, channel, rows=()):
+        self.journal = journal
+        self.channel = channel
+        self.items = OrderedDict(rows)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __contains__(self, url):
+        return url in self.items
+
+    def __getitem__(self, index):
+        if index == 0 and self.items:
+            return next(iter(self.items))
+        return list(self.items)[index]
+
+    def append(self, url):
+        if url in self.items:
+            return False
+        position = next(reversed(self.items.values())) + 1 if self.items else 0
+        self.items[url] = position
+        self.journal.record('add', url, position)
+        event_bus.publish('queue', {'channel': self.channel, 'op': 'add', 'url': url, 'index': len(self.items) - 1})
+        return True
+
+    def appendleft(self, url):
+        if url in self.items:
+            return False
+        position = next(iter(self.items.values())) - 1 if self.items else 0
+        self.items[url] = position
+        self.items.move_to_end(url, last=False)
+        self.journal.record('add', url, position)
+        event_bus.publish('queue', {'channel': self.channel, 'op': 'add', 'url': url, 'index': 0})
+        return True
+
+    def popleft(self):
+        if not self.items:
+            raise IndexError('pop from an empty queue')
+        url, _ = self.items.popitem(last=False)
+        self.journal.record('remove', url)
+        event_bus.publish('queue', {'channel': self.channel, 'op': 'remove', 'url': url})
+        return url
+
+    def remove(self, url):
+        if url not in self.items:
+            raise ValueError(url)
+        del self.items[url]
+        self.journal.record('remove', url)
+        event_bus.publish('queue', {'channel': self.channel, 'op': 'remove', 'url': url})
+
+    def clear(self):
+        self.items.clear()
+        self.journal.record('clear')
+        event_bus.publish('queue', {'channel': self.channel, 'op': 'clear'})
+
+    def reorder(self, urls):
+        self.items = OrderedDict((url, position) for position, url in enumerate(urls))
+        self.journal.record('rewrite', list(self.items.items()))
+        event_bus.publish('queue', {'channel': self.channel, 'op': 'reorder', 'urls': list(self.items)})
+
+
+class PlayedHistory:
+    def __init__(self, journal, channel, urls=()):
+        self.journal = journal
+        self.channel = channel
+        self.urls = OrderedDict.fromkeys(urls)
+
+    def __len__(self):
+        return len(self.urls)
+
+    def __iter__(self):
+        return iter(self.urls)
+
+    def __contains__(self, url):
+        return url in self.urls
+
+    def add(self, url):
+        self.urls[url] = None
+        self.urls.move_to_end(url)
+        self.journal.record('played', url, time.time())
+        event_bus.publish('played', {'channel': self.channel, 'op': 'add', 'url': url})
+
+    def clear(self):
+        self.urls.clear()
+        self.journal.record('clear_played')
+        event_bus.publish('played', {'channel': self.channel, 'op': 'clear'})
+
+
+def restore_queue(path, channel, default_url):
+    journal = QueueJournal(path, QUEUE_COMMIT_INTERVAL)
+    queue_rows, played_urls, now_playing = journal.load()
+    # Rows journalled before URLs were canonicalised are rewritten once.
+    canonical_rows = OrderedDict()
+    for url, position in queue_rows:
+        canonical_rows.setdefault(canonical_url(url), position)
+    queue = PersistentQueue(journal, channel, canonical_rows.items())
+    if list(canonical_rows) != [url for url, _ in queue_rows]:
+        queue.reorder(list(canonical_rows))
+    played = PlayedHistory(journal, channel, [canonical_url(url) for url in played_urls])
+    now_playing = [canonical_url(url) for url in now_playing]
+    # Whatever was on air or pre-spawned when the process died goes back to
+    # the head of the queue, and picks up where it left off (journal.resume).
+    for url in reversed(now_playing):
+        if url != default_url and url not in played:
+            queue.appendleft(url)
+    return journal, queue, played
+
+
+class VideoCache:
+    def __init__(self, root, budget, policy):
+        self.root = root
+        self.objects_dir = os.path.join(root, 'objects')
+        self.index_path = os.path.join(root, 'index.json')
+        self.budget = budget
+        self.policy = policy
+        self.lock = threading.Lock()
+        self.objects = {}
+        self.urls = {}
+        self.load()
+
+    def load(self):
+        os.makedirs(self.objects_dir, exist_ok=True)
+        try:
+            with open(self.index_path, 'r') as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+        for digest, entry in index.get('objects', {}).items():
+            try:
+                if os.path.getsize(os.path.join(self.objects_dir, entry['file'])) != entry['size']:
+                    continue
+            except (OSError, KeyError):
+                continue
+            if entry.get('ready') and not os.path.exists(os.path.join(self.objects_dir, entry['ready'])):
+                entry.update({'ready': None, 'ready_size': 0, 'ingest': None})
+            self.objects[digest] = entry
+        self.urls = {canonical_url(url): digest for url, digest in index.get('urls', {}).items() if digest in self.objects}
+
+    def save(self):
+        try:
+            write_file_atomic(self.index_path, json.dumps({'objects': self.objects, 'urls': self.urls}))
+        except OSError as e:
+            pass
+
+    def path_for(self, entry):
+        return os.path.join(self.objects_dir, entry['file'])
+
+    def ready_path_for(self, entry):
+        return os.path.join(self.objects_dir, entry['ready']) if entry.get('ready') else None
+
+    def digest_for(self, url):
+        with self.lock:
+            return self.urls.get(url)
+
+    def source_path(self, digest):
+        with self.lock:
+            entry = self.objects.get(digest)
+            return self.path_for(entry) if entry else None
+
+    def ingest_state(self, digest):
+        with self.lock:
+            entry = self.objects.get(digest)
+            return entry.get('ingest') if entry else None
+
+    def ready_path(self, url):
+        with self.lock:
+            entry = self.objects.get(self.urls.get(url))
+            path = self.ready_path_for(entry) if entry else None
+        return path if path and os.path.exists(path) else None
+
+    def finish_ingest(self, digest, ready_file, media):
+        with self.lock:
+            entry = self.objects.get(digest)
+            if not entry:
+                # Evicted while normalising; the artifact has no owner any more.
+                if ready_file:
+                    ready_path = os.path.join(self.objects_dir, ready_file)
+                    for artifact in (ready_path, keyframe_index_path(ready_path)):
+                        try:
+                            os.remove(artifact)
+                        except OSError:
+                            pass
+                return
+            entry['ingest'] = 'ready' if ready_file else 'failed'
+            entry['ready'] = ready_file
+            entry['ready_size'] = 0
+            if ready_file and ready_file != entry['file']:
+                try:
+                    entry['ready_size'] = os.path.getsize(os.path.join(self.objects_dir, ready_file))
+                except OSError:
+                    entry.update({'ready': None, 'ingest': 'failed'})
+            entry['media'] = media
+            self.save()
+        self.evict()
+
+    def lookup(self, url):
+        with self.lock:
+            digest = self.urls.get(url)
+            entry = self.objects.get(digest)
+            if not entry:
+                return None
+            path = self.path_for(entry)
+            try:
+                if os.path.getsize(path) == entry['size']:
+                    return path
+            except OSError:
+                pass
+            self.drop(digest)
+            self.save()
+            return None
+
+    def admit(self, url, path, digest=None):
+        try:
+            size = os.path.getsize(path)
+            digest = digest or hash_file(path)
+        except OSError:
+            return None
+        _, ext = os.path.splitext(path)
+        with self.lock:
+            entry = self.objects.get(digest)
+            if entry and os.path.exists(self.path_for(entry)):
+                # Same bytes under another URL (e.g. a different rlkey/st variant).
+                if os.path.abspath(path) != os.path.abspath(self.path_for(entry)):
+                    os.remove(path)
+            else:
+                entry = {'file': f"{digest}{ext}", 'size': size, 'added_at': time.time(), 'last_played': None, 'play_count': 0,
+                         'ready': None, 'ready_size': 0, 'ingest': None, 'media': None}
+                os.replace(path, self.path_for(entry))
+                self.objects[digest] = entry
+            self.urls[url] = digest
+            self.save()
+            final_path = self.path_for(entry)
+        self.evict()
+        return final_path
+
+    def mark_played(self, url):
+        with self.lock:
+            entry = self.objects.get(self.urls.get(url))
+            if entry:
+                entry['last_played'] = time.time()
+                entry['play_count'] += 1
+                self.save()
+
+    def drop(self, digest):
+        entry = self.objects.pop(digest, None)
+        self.urls = {url: d for url, d in self.urls.items() if d != digest}
+        if entry:
+            for path in {self.path_for(entry), self.ready_path_for(entry)} - {None}:
+                for artifact in (path, keyframe_index_path(path)):
+                    try:
+                        os.remove(artifact)
+                    except OSError:
+                        pass
+            try:
+                filler_names = os.listdir(FILLER_DIR)
+            except OSError:
+                filler_names = []
+            for name in filler_names:
+                if name.startswith(f"{digest}-"):
+                    shutil.rmtree(os.path.join(FILLER_DIR, name), ignore_errors=True)
+
+    def entry_bytes(self, entry):
+        return entry['size'] + entry.get('ready_size', 0)
+
+    def eviction_key(self, entry):
+        last_used = entry['last_played'] or entry['added_at']
+        if self.policy == 'lfu':
+            return (entry['play_count'], last_used)
+        return (last_used, entry['play_count'])
+
+    def evict(self):
+        if self.budget <= 0:
+            return
+        protected = {os.path.abspath(p) for p in protected_video_paths()}
+        with self.lock:
+            total = sum(self.entry_bytes(entry) for entry in self.objects.values())
+            if total <= self.budget:
+                return
+            candidates = sorted(self.objects.items(), key=lambda item: self.eviction_key(item[1]))
+            for digest, entry in candidates:
+                if total <= self.budget:
+                    break
+                if {os.path.abspath(p) for p in (self.path_for(entry), self.ready_path_for(entry)) if p} & protected:
+                    continue
+                total -= self.entry_bytes(entry)
+                self.drop(digest)
+            self.save()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'objects': len(self.objects),
+                'urls': len(self.urls),
+                'bytes': sum(self.entry_bytes(entry) for entry in self.objects.values()),
+                'stream_ready': sum(1 for entry in self.objects.values() if entry.get('ingest') == 'ready'),
+                'budget_bytes': self.budget,
+                'policy': self.policy,
+            }
+
+
+video_cache = VideoCache(VIDEO_DIR, VIDEO_CACHE_BUDGET_BYTES, VIDEO_CACHE_POLICY)
+
+
+class RateLimiter:
+    def __init__(self, bytes_per_second):
+        self.rate = bytes_per_second
+        self.lock = threading.Lock()
+        self.allowance = float(bytes_per_second)
+        self.updated_at = time.monotonic()
+
+    def consume(self, amount):
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.allowance = min(self.rate, self.allowance + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.allowance -= amount
+            delay = -self.allowance / self.rate if self.allowance < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+
+class IngestManager:
+    def __init__(self, workers, on_complete=None):
+        self.workers = workers
+        self.on_complete = on_complete
+        self.cond = threading.Condition()
+        self.pending = deque()
+        self.submitted_at = {}
+        self.active = set()
+        self.threads = []
+
+    def start(self):
+        if not INGEST_ENABLED:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.worker, name=f"Ingest-{i + 1}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, url):
+        if not INGEST_ENABLED:
+            return
+        digest = video_cache.digest_for(url)
+        if not digest or video_cache.ingest_state(digest):
+            return
+        with self.cond:
+            if digest in self.submitted_at:
+                return
+            self.submitted_at[digest] = time.time()
+            self.pending.append(digest)
+            self.cond.notify_all()
+
+    def should_wait(self, url):
+        digest = video_cache.digest_for(url)
+        with self.cond:
+            submitted_at = self.submitted_at.get(digest)
+        return submitted_at is not None and time.time() - submitted_at < INGEST_MAX_WAIT_SECONDS
+
+    def run(self, digest):
+        source_path = video_cache.source_path(digest)
+        if not source_path:
+            return
+        media = probe_media(source_path)
+        ready_file = None
+        if media:
+            keyframes = None
+            keyframe_interval = None
+            if media['video']:
+                keyframes = probe_keyframes(source_path)
+                keyframe_interval = max_keyframe_interval(keyframes, media['duration'])
+            video_ready, audio_ready = ingest_plan(media, keyframe_interval)
+            media['max_keyframe_interval'] = keyframe_interval
+            if video_ready and audio_ready:
+                ready_file = os.path.basename(source_path)
+                save_keyframe_index(source_path, keyframes)
+            else:
+                ready_file = f"{digest}.ready.mp4"
+                ready_path = os.path.join(video_cache.objects_dir, ready_file)
+                if normalize_video(source_path, ready_path, video_ready, audio_ready):
+                    load_keyframe_index(ready_path)
+                else:
+                    ready_file = None
+        if stop_event.is_set():
+            return
+        video_cache.finish_ingest(digest, ready_file, media)
+
+    def worker(self):
+        while not stop_event.is_set():
+            with self.cond:
+                while not self.pending and not stop_event.is_set():
+                    self.cond.wait(timeout=1)
+                if stop_event.is_set():
+                    return
+                digest = self.pending.popleft()
+                self.active.add(digest)
+            try:
+                self.run(digest)
+            except Exception as e:
+                pass
+            finally:
+                with self.cond:
+                    self.active.discard(digest)
+                    self.submitted_at.pop(digest, None)
+            if self.on_complete:
+                self.on_complete()
+
+    def stop(self, timeout=5):
+        # Workers terminate their ffmpeg once stop_event is set; wait for that.
+        with self.cond:
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join(timeout=timeout)
+
+    def snapshot(self):
+        with self.cond:
+            return {'pending': len(self.pending), 'active': sorted(self.active)}
+
+
+class DownloadManager:
+    def __init__(self, workers, depth, rate_limiter=None, on_complete=None):
+        self.workers = workers
+        self.depth = depth
+        self.rate_limiter = rate_limiter
+        self.on_complete = on_complete
+        self.cond = threading.Condition()
+        self.jobs = {}
+        self.pending = deque()
+        self.threads = []
+        self.bytes_downloaded = 0
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.worker, name=f"Prefetch-{i + 1}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def new_job(self, url, filename):
+        return {
+            'url': url,
+            'filename': filename,
+            'state': 'queued',
+            'path': None,
+            'downloaded': 0,
+            'total': None,
+            'started_at': None,
+            'finished_at': None,
+            'published_at': None,
+            'retries': 0,
+        }
+
+    def prefetch(self, urls):
+        with self.cond:
+            for url in urls[:self.depth]:
+                filename = get_safe_filename(url)
+                job = self.jobs.get(filename)
+                if job and job['state'] in ('queued', 'downloading'):
+                    continue
+                if video_cache.lookup(url):
+                    ingest_manager.submit(url)
+                    continue
+                if job and time.time() - job['finished_at'] < PREFETCH_RETRY_SECONDS:
+                    continue
+                self.jobs[filename] = self.new_job(url, filename)
+                self.pending.append(filename)
+            self.prune()
+            self.cond.notify_all()
+
+    def fetch(self, url, filename):
+        # Playback never waits for a free worker: a queued job is taken over
+        # and downloaded right here without the prefetch rate cap.
+        with self.cond:
+            job = self.jobs.get(filename)
+            while job and job['state'] == 'downloading' and not stop_event.is_set():
+                self.cond.wait(timeout=1)
+                job = self.jobs.get(filename)
+            cached_path = video_cache.lookup(url)
+            if cached_path:
+                return cached_path
+            if job and job['state'] == 'queued':
+                try:
+                    self.pending.remove(filename)
+                except ValueError:
+                    pass
+            job = self.new_job(url, filename)
+            self.jobs[filename] = job
+            job['state'] = 'downloading'
+        return self.run(job, rate_limiter=None)
+
+    def publish(self, job):
+        job['published_at'] = time.time()
+        event_bus.publish('download', {key: job[key] for key in ('url', 'filename', 'state', 'downloaded', 'total', 'retries')})
+
+    def run(self, job, rate_limiter):
+        job['started_at'] = time.time()
+        self.publish(job)
+        counted = None
+
+        def progress(downloaded, total):
+            nonlocal counted
+            # The first report is what a resumed download already had on disk.
+            if counted is not None and downloaded > counted:
+                with self.cond:
+                    self.bytes_downloaded += downloaded - counted
+            counted = downloaded
+            job['downloaded'] = downloaded
+            job['total'] = total
+            if time.time() - job['published_at'] >= DOWNLOAD_EVENT_INTERVAL:
+                self.publish(job)
+
+        def on_retry(attempt):
+            job['retries'] = attempt
+            self.publish(job)
+
+        path, digest = download_video(job['url'], job['filename'], progress=progress, rate_limiter=rate_limiter, on_retry=on_retry)
+        if path:
+            path = video_cache.admit(job['url'], path, digest)
+        if path:
+            ingest_manager.submit(job['url'])
+        with self.cond:
+            job['path'] = path
+            job['state'] = 'done' if path else 'failed'
+            job['finished_at'] = time.time()
+            self.cond.notify_all()
+        self.publish(job)
+        if self.on_complete:
+            self.on_complete()
+        return path
+
+    def worker(self):
+        while not stop_event.is_set():
+            with self.cond:
+                while not self.pending and not stop_event.is_set():
+                    self.cond.wait(timeout=1)
+                if stop_event.is_set():
+                    return
+                job = self.jobs.get(self.pending.popleft())
+                if not job or job['state'] != 'queued':
+                    continue
+                job['state'] = 'downloading'
+            self.run(job, rate_limiter=self.rate_limiter)
+
+    def forget(self, filename):
+        with self.cond:
+            job = self.jobs.get(filename)
+            if job and job['state'] in ('done', 'failed'):
+                del self.jobs[filename]
+
+    def has_failed(self, filename):
+        with self.cond:
+            job = self.jobs.get(filename)
+            return bool(job and job['state'] == 'failed')
+
+    def prune(self):
+        finished = [name for name, job in self.jobs.items() if job['state'] in ('done', 'failed')]
+        for name in finished[:max(0, len(finished) - DOWNLOAD_HISTORY_SIZE)]:
+            del self.jobs[name]
+
+    def snapshot(self):
+        with self.cond:
+            jobs = [dict(job) for job in self.jobs.values()]
+        now = time.time()
+        for job in jobs:
+            elapsed = (job['finished_at'] or now) - job['started_at'] if job['started_at'] else 0
+            job['percent'] = round(100.0 * job['downloaded'] / job['total'], 1) if job['total'] else None
+            job['bytes_per_second'] = int(job['downloaded'] / elapsed) if elapsed > 0 else 0
+        return jobs
+
+
+ingest_manager = IngestManager(INGEST_WORKERS, on_complete=notify_scheduler)
+download_manager = DownloadManager(PREFETCH_WORKERS, PREFETCH_DEPTH, RateLimiter(PREFETCH_RATE_LIMIT), on_complete=notify_scheduler)
+
+
+def kill_if_running(process):
+    if process.poll() is None:
+        try:
+            process.kill()
+        except Exception as e:
+            pass
+
+
+def stop_process(process, wait=True):
+    if not process or process.poll() is not None:
+        return
+    try:
+        if os.name == 'nt':
+            subprocess.run(['taskkill', '/F', '/PID', str(process.pid)], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        else:
+            process.terminate()
+            if not wait:
+                # The pipeline's exit watcher reaps it and wakes the scheduler.
+                timer = threading.Timer(5, kill_if_running, args=(process,))
+                timer.daemon = True
+                timer.start()
+                return
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+    except Exception as e:
+        pass
+
+
+def write_file_atomic(path, data):
+    tmp_path = f"{path}.tmp"
+    mode = 'wb' if isinstance(data, bytes) else 'w'
+    with open(tmp_path, mode) as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def probe_duration(video_path):
+    try:
+        result = subprocess.run(
+            ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'default=noprint_wrappers=1:nokey=1', video_path],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=30, text=True)
+        duration = float(result.stdout.strip())
+        return duration if duration > 0 else None
+    except Exception as e:
+        return None
+
+
+def probe_media(video_path):
+    try:
+        result = subprocess.run(
+            ['ffprobe', '-v', 'error', '-show_entries',
+             'format=duration:stream=codec_type,codec_name,pix_fmt,sample_rate,channels',
+             '-of', 'json', video_path],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=60, text=True)
+        probe = json.loads(result.stdout)
+    except Exception as e:
+        return None
+    media = {'duration': None, 'video': None, 'audio': None}
+    try:
+        media['duration'] = float(probe.get('format', {}).get('duration'))
+    except (TypeError, ValueError):
+        pass
+    for stream in probe.get('streams', []):
+        kind = stream.get('codec_type')
+        if kind == 'video' and media['video'] is None:
+            media['video'] = {'codec': stream.get('codec_name'), 'pix_fmt': stream.get('pix_fmt')}
+        elif kind == 'audio' and media['audio'] is None:
+            media['audio'] = {
+                'codec': stream.get('codec_name'),
+                'sample_rate': int(stream.get('sample_rate') or 0),
+                'channels': stream.get('channels'),
+            }
+    return media
+
+
+def probe_keyframes(video_path):
+    # Packet flags only, so the file is read but never decoded.
+    try:
+        result = subprocess.run(
+            ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'packet=pts_time,flags',
+             '-of', 'csv=p=0', video_path],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=600, text=True)
+    except Exception as e:
+        return None
+    keyframes = []
+    for line in result.stdout.splitlines():
+        pts_time, _, flags = line.partition(',')
+        if 'K' in flags:
+            try:
+                keyframes.append(float(pts_time))
+            except ValueError:
+                pass
+    return sorted(keyframes)
+
+
+def max_keyframe_interval(keyframes, duration):
+    if not keyframes:
+        return None
+    points = keyframes + ([duration] if duration and duration > keyframes[-1] else [])
+    return max((b - a for a, b in zip(points, points[1:])), default=0.0)
+
+
+def keyframe_index_path(video_path):
+    return f"{video_path}.keyframes.json"
+
+
+def save_keyframe_index(video_path, keyframes):
+    # Stored relative to the first keyframe, which is what -ss counts from.
+    if not keyframes:
+        return
+    try:
+        size = os.path.getsize(video_path)
+        relative = [round(k - keyframes[0], 6) for k in keyframes]
+        write_file_atomic(keyframe_index_path(video_path), json.dumps({'size': size, 'keyframes': relative}))
+    except OSError as e:
+        pass
+
+
+def load_keyframe_index(video_path):
+    # Normally written at ingest; built here once for files that skipped it.
+    try:
+        with open(keyframe_index_path(video_path), 'r') as f:
+            index = json.load(f)
+        if index['size'] == os.path.getsize(video_path):
+            return index['keyframes']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    keyframes = probe_keyframes(video_path)
+    save_keyframe_index(video_path, keyframes)
+    return [round(k - keyframes[0], 6) for k in keyframes] if keyframes else None
+
+
+def video_copied():
+    # Only an ABR ladder re-encodes video, and its source rendition still copies it.
+    return not ABR_LADDER or any(ABR_RENDITIONS[name] is None for name in ABR_LADDER)
+
+
+def seek_offset(video_path, offset):
+    # A copied stream can only start on a keyframe; a transcode seeks exactly.
+    # A progressive start reads from the URL, which has no index to snap to.
+    if offset <= 0:
+        return 0.0
+    if not video_copied() or not os.path.isfile(video_path):
+        return offset
+    keyframes = load_keyframe_index(video_path)
+    if not keyframes:
+        return offset
+    i = bisect.bisect_right(keyframes, offset + 0.001)
+    return keyframes[i - 1] if i else 0.0
+
+
+def ingest_plan(media, keyframe_interval):
+    video, audio = media['video'], media['audio']
+    video_ready = video is None or (
+        video['codec'] == 'h264'
+        and video['pix_fmt'] in ('yuv420p', 'yuvj420p')
+        and keyframe_interval is not None
+        and keyframe_interval <= INGEST_MAX_KEYFRAME_INTERVAL)
+    audio_ready = audio is None or (
+        audio['codec'] == 'aac' and audio['sample_rate'] == 44100 and audio['channels'] == 2)
+    return video_ready, audio_ready
+
+
+def normalize_video(source_path, output_path, video_ready, audio_ready):
+    command = ['ffmpeg', '-v', 'error', '-y', '-i', source_path, '-map', '0:v:0?', '-map', '0:a:0?']
+    if video_ready:
+        command.extend(['-c:v', 'copy'])
+    else:
+        command.extend([
+            '-c:v', 'libx264',
+            '-preset', INGEST_PRESET,
+            '-crf', str(INGEST_CRF),
+            '-pix_fmt', 'yuv420p',
+            '-force_key_frames', f'expr:gte(t,n_forced*{HLS_TIME})',
+            '-sc_threshold', '0',
+        ])
+    if audio_ready:
+        command.extend(['-c:a', 'copy'])
+    else:
+        command.extend(['-c:a', 'aac', '-b:a', '128k', '-ac', '2', '-ar', '44100'])
+    tmp_path = f"{output_path}.tmp"
+    command.extend(['-movflags', '+faststart', '-f', 'mp4', tmp_path])
+    # Niced so a long ingest never starves the live pipeline of CPU.
+    preexec_fn = (lambda: os.nice(10)) if hasattr(os, 'nice') else None
+    try:
+        process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.DEVNULL, preexec_fn=preexec_fn)
+    except Exception as e:
+        return False
+    while process.poll() is None:
+        if stop_event.is_set():
+            stop_process(process)
+            break
+        try:
+            process.wait(timeout=1)
+        except subprocess.TimeoutExpired:
+            pass
+    if process.returncode == 0 and not stop_event.is_set():
+        os.replace(tmp_path, output_path)
+        return True
+    try:
+        os.remove(tmp_path)
+    except OSError:
+        pass
+    return False
+
+
+def parse_media_playlist(text):
+    media_sequence = 0
+    segments = []
+    segment = {}
+    init_uri = None
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('#EXT-X-MEDIA-SEQUENCE:'):
+            media_sequence = int(line.split(':', 1)[1])
+        elif line.startswith('#EXTINF:'):
+            segment['duration'] = float(line.split(':', 1)[1].split(',', 1)[0])
+        elif line.startswith('#EXT-X-MAP:'):
+            init_uri = line.split('URI="', 1)[1].split('"', 1)[0]
+        elif not line.startswith('#'):
+            segment['uri'] = line
+            segment.setdefault('duration', float(HLS_TIME))
+            if init_uri:
+                segment['map'] = init_uri
+            segments.append(segment)
+            segment = {}
+    return media_sequence, segments
+
+
+def format_program_date_time(timestamp):
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(timestamp)) + f".{int(timestamp * 1000) % 1000:03d}+0000"
+
+
+def valid_start_at(start_at):
+    # Has to survive being rendered as a PROGRAM-DATE-TIME.
+    if not math.isfinite(start_at):
+        return False
+    try:
+        format_program_date_time(start_at)
+    except (OverflowError, OSError, ValueError):
+        return False
+    return True
+
+
+def reset_stream_output(output_dir):
+    # Only our own files: the main channel's directory also holds the others.
+    try:
+        os.makedirs(output_dir, exist_ok=True)
+        for f in os.listdir(output_dir):
+            path = os.path.join(output_dir, f)
+            if f == LIVE_DIR_NAME:
+                shutil.rmtree(path, ignore_errors=True)
+            elif f.endswith('.ts') or f.endswith('.m3u8') or f.endswith('.tmp'):
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    pass
+        os.makedirs(os.path.join(output_dir, LIVE_DIR_NAME), exist_ok=True)
+    except Exception as e:
+        pass
+
+
+def progress_number(value, suffix=''):
+    if value and suffix and value.endswith(suffix):
+        value = value[:-len(suffix)]
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def progressive_allowed(url):
+    failed_at = progressive_failed.get(url)
+    if failed_at is None:
+        return True
+    if time.time() - failed_at < PROGRESSIVE_RETRY_SECONDS:
+        return False
+    progressive_failed.pop(url, None)
+    return True
+
+
+def progressive_start_failed(url):
+    # Expired entries are dropped here, so the map only holds recent failures.
+    now = time.time()
+    for failed_url, failed_at in list(progressive_failed.items()):
+        if now - failed_at >= PROGRESSIVE_RETRY_SECONDS:
+            progressive_failed.pop(failed_url, None)
+    progressive_failed[url] = now
+
+
+class HlsPipeline:
+    def __init__(self, channel, url, video_path, loop=False, stream_ready=False, progressive=False, start_offset=0.0, restarts=0):
+        self.id = f"{RUN_ID}-{next(pipeline_ids)}"
+        self.channel = channel
+        self.url = url
+        self.video_path = video_path
+        self.loop = loop
+        self.stream_ready = stream_ready
+        self.progressive = progressive
+        self.start_offset = start_offset
+        self.restarts = restarts
+        self.first_segment_at = None
+        self.last_segment_at = None
+        self.produced_seconds = 0.0
+        self.published_seconds = 0.0
+        self.produced_bytes = 0
+        self.written_origin = None
+        self.progress = {}
+        self.stderr_tail = deque(maxlen=FFMPEG_STDERR_LINES)
+        self.stalled = False
+        self.stopping = False
+        self.output_dir = os.path.join(channel.live_dir, str(self.id))
+        self.variants = STREAM_VARIANTS
+        self.process = None
+        self.started_at = None
+        self.duration = None
+        self.next_sequence = {variant: 0 for variant in self.variants}
+        self.playlist_stamps = {}
+        self.pending = {variant: deque() for variant in self.variants}
+        self.cancelled = False
+        self.schedule_entry = None
+        self.push_failures = {}
+
+    def start(self):
+        self.process = start_ffmpeg_stream(self.video_path, self.output_dir, loop=self.loop, stream_ready=self.stream_ready,
+                                           progressive=self.progressive, start_offset=self.start_offset,
+                                           push_targets=self.channel.push_targets)
+        self.started_at = time.time()
+        if self.process is None:
+            return False
+        video_cache.mark_played(self.url)
+        if not self.progressive:
+            progressive_failed.pop(self.url, None)
+        self.publish('started', start_offset=self.start_offset, restarts=self.restarts)
+        threading.Thread(target=self.watch, name=f"Exit-{self.id}", daemon=True).start()
+        threading.Thread(target=self.read_progress, name=f"Progress-{self.id}", daemon=True).start()
+        if not self.loop:
+            threading.Thread(target=self.probe, name=f"Probe-{self.id}", daemon=True).start()
+        return True
+
+    def watch(self):
+        try:
+            for line in self.process.stderr:
+                line = line.rstrip()
+                if line:
+                    self.stderr_tail.append(line)
+                    match = TEE_SLAVE_FAILED.search(line)
+                    # Stopping ffmpeg fails every output on its way out.
+                    if match and not self.stopping:
+                        self.push_failed(int(match.group(1)) - 1, match.group(2))
+            self.process.wait()
+        finally:
+            extra = {'returncode': self.process.returncode}
+            if self.process.returncode and not self.stopping:
+                extra['stderr'] = list(self.stderr_tail)
+            self.publish('exited', **extra)
+            self.channel.notify()
+
+    def read_progress(self):
+        # -progress writes key=value blocks, each closed by a progress= line.
+        block = {}
+        for line in self.process.stdout:
+            key, _, value = line.strip().partition('=')
+            if key != 'progress':
+                block[key] = value
+                continue
+            out_time_us = progress_number(block.get('out_time_us'))
+            self.progress = {
+                'frame': progress_number(block.get('frame')),
+                'fps': progress_number(block.get('fps')),
+                'bitrate_kbps': progress_number(block.get('bitrate'), 'kbits/s'),
+                'speed': progress_number(block.get('speed'), 'x'),
+                'out_time': round(out_time_us / 1000000, 3) if out_time_us is not None else None,
+                'total_size': progress_number(block.get('total_size')),
+                'updated_at': time.time(),
+            }
+            block = {}
+
+    def push_failed(self, index, error):
+        # tee output #0 is the HLS muxer, so push target i is output i + 1.
+        targets = self.channel.push_targets
+        if not 0 <= index < len(targets):
+            return
+        self.push_failures[index] = {'error': error, 'failed_at': time.time()}
+        with self.channel.lock:
+            self.channel.push_failure_count[index] += 1
+        event_bus.publish('push', {'channel': self.channel.name, 'pipeline': self.id, 'target': targets[index]['name'],
+                                   'state': 'failed', 'error': error})
+
+    def publish(self, state, **extra):
+        event_bus.publish('pipeline', dict(extra, state=state, channel=self.channel.name, id=self.id, url=self.url,
+                                           loop=self.loop, mode=self.start_mode()))
+
+    def probe(self):
+        self.duration = probe_duration(self.video_path)
+        self.channel.notify()
+
+    def is_running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def remaining(self):
+        # Counted from what has been published: a pipeline that went on air
+        # pre-spawned runs ahead of viewers by its backlog, and timing the next
+        # pre-spawn from ffmpeg's clock would add that backlog on every handoff.
+        if self.loop or self.duration is None or self.started_at is None:
+            return None
+        return self.duration - self.playback_position()
+
+    def backlog_seconds(self):
+        # Written by ffmpeg but not yet handed to viewers.
+        return self.produced_seconds - self.published_seconds
+
+    def resume_position(self):
+        # Only whole segments count: a partly written one is lost with the process.
+        return 0.0 if self.loop else self.start_offset + self.produced_seconds
+
+    def playback_position(self):
+        # What viewers have been handed so far, as opposed to what ffmpeg has written.
+        return 0.0 if self.loop else self.start_offset + self.published_seconds
+
+    def poll_segments(self):
+        for variant in self.variants:
+            self.poll_variant(variant)
+
+    def poll_variant(self, variant):
+        playlist_path = os.path.join(self.output_dir, variant, 'index.m3u8')
+        try:
+            stat = os.stat(playlist_path)
+            stamp = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            if stamp == self.playlist_stamps.get(variant):
+                return
+            with open(playlist_path, 'r') as f:
+                text = f.read()
+        except OSError:
+            return
+        self.playlist_stamps[variant] = stamp
+        media_sequence, segments = parse_media_playlist(text)
+        for offset, segment in enumerate(segments):
+            sequence = media_sequence + offset
+            if sequence < self.next_sequence[variant]:
+                continue
+            segment['uri'] = f"{LIVE_DIR_NAME}/{self.id}/{variant}/{segment['uri']}"
+            if 'map' in segment:
+                segment['map'] = f"{LIVE_DIR_NAME}/{self.id}/{variant}/{segment['map']}"
+            segment['pipeline'] = self.id
+            self.pending[variant].append(segment)
+            self.next_sequence[variant] = sequence + 1
+            if variant == self.variants[0]:
+                self.record_segment(segment)
+            if self.first_segment_at is None:
+                self.first_segment_at = time.time()
+                self.record_startup()
+
+    def record_segment(self, segment):
+        self.produced_seconds += segment['duration']
+        self.last_segment_at = time.time()
+        try:
+            stat = os.stat(os.path.join(self.channel.output_dir, segment['uri']))
+        except OSError:
+            return
+        self.produced_bytes += stat.st_size
+        if self.written_origin is None:
+            # -re reads ahead at first, so the pace is measured from the first segment on.
+            self.written_origin = stat.st_mtime - self.produced_seconds
+            return
+        self.channel.segment_latency.observe(max(0.0, stat.st_mtime - self.written_origin - self.produced_seconds))
+
+    def bitrate_kbps(self):
+        # The HLS muxer leaves -progress without a size, so fall back to what was written.
+        bitrate = self.progress.get('bitrate_kbps')
+        if bitrate is None and self.produced_seconds > 0:
+            bitrate = round(self.produced_bytes * 8 / self.produced_seconds / 1000, 1)
+        return bitrate
+
+    def start_mode(self):
+        if self.progressive:
+            return 'progressive'
+        if any(ABR_RENDITIONS[name] for name in ABR_LADDER):
+            return 'transcode'
+        # Otherwise the video is copied and only the audio may be re-encoded.
+        return 'copy' if self.stream_ready else 'audio_transcode'
+
+    def record_startup(self):
+        startup_history.append({
+            'channel': self.channel.name,
+            'url': self.url,
+            'pipeline': self.id,
+            'mode': self.start_mode(),
+            'loop': self.loop,
+            'started_at': self.started_at,
+            'time_to_first_segment': round(self.first_segment_at - self.started_at, 3),
+        })
+        self.publish('first_segment', time_to_first_segment=startup_history[-1]['time_to_first_segment'])
+
+    def start_failed(self):
+        # Only a progressive start is abandoned: it still has the full download to fall back on.
+        if not self.progressive or self.first_segment_at is not None:
+            return False
+        self.poll_segments()
+        if self.first_segment_at is not None:
+            return False
+        return not self.is_running() or time.time() - self.started_at > PROGRESSIVE_START_TIMEOUT
+
+    def is_stalled(self):
+        if self.stalled or self.stopping or not self.is_running():
+            return False
+        if self.progressive and self.first_segment_at is None:
+            # start_failed() already bounds a progressive start.
+            return False
+        return time.time() - (self.last_segment_at or self.started_at) > FFMPEG_STALL_SECONDS
+
+    def mark_stalled(self):
+        self.stalled = True
+        self.channel.stall_count += 1
+        self.publish('stalled', progress=self.progress, stderr=list(self.stderr_tail))
+        self.stop(wait=False)
+
+    def needs_restart(self):
+        # A stall or ffmpeg dying on its own, as opposed to reaching the end or being stopped.
+        if self.cancelled or self.process is None or self.is_running():
+            return False
+        if not self.stalled and (self.stopping or self.process.returncode == 0):
+            return False
+        if self.loop or self.duration is None:
+            return True
+        return self.resume_position() < self.duration - HLS_TIME
+
+    def has_pending(self):
+        return any(self.pending.values())
+
+    def is_ready(self):
+        # Every rendition must have something to publish so they switch together.
+        return all(self.pending.values())
+
+    def is_finished(self):
+        if self.is_running():
+            return False
+        self.poll_segments()
+        return not self.has_pending()
+
+    def stop(self, discard=False, wait=True):
+        self.stopping = True
+        stop_process(self.process, wait=wait)
+        if discard:
+            for pending in self.pending.values():
+                pending.clear()
+
+    def remove_output(self):
+        shutil.rmtree(self.output_dir, ignore_errors=True)
+        self.channel.store.discard_prefix(f"{LIVE_DIR_NAME}/{self.id}/")
+
+
+class FillerPipeline(HlsPipeline):
+    # Loops the default video by replaying its pre-cut segments under fresh
+    # URIs: nothing to spawn, and ready the moment it is created.
+    def __init__(self, channel, url, video_path, filler):
+        super().__init__(channel, url, video_path, loop=True, stream_ready=True)
+        self.filler = filler
+        self.running = False
+
+    def start(self):
+        self.started_at = time.time()
+        self.running = True
+        self.publish('started', start_offset=0.0, restarts=0)
+        self.poll_segments()
+        return True
+
+    def is_running(self):
+        return self.running
+
+    def poll_segments(self):
+        if self.running:
+            super().poll_segments()
+
+    def poll_variant(self, variant):
+        pending = self.pending[variant]
+        segments = self.filler[variant]
+        while sum(segment['duration'] for segment in pending) < FILLER_LEAD_SECONDS:
+            sequence = self.next_sequence[variant]
+            source = segments[sequence % len(segments)]
+            segment = {
+                'uri': f"{LIVE_DIR_NAME}/{self.id}/{variant}/filler{sequence:06d}{os.path.splitext(source['path'])[1]}",
+                'path': source['path'],
+                'duration': source['duration'],
+                'pipeline': self.id,
+                # Timestamps start over with every pass.
+                'discontinuity': sequence > 0 and sequence % len(segments) == 0,
+            }
+            if source['map_path']:
+                segment['map'] = f"{LIVE_DIR_NAME}/{self.id}/{variant}/init.mp4"
+                segment['map_path'] = source['map_path']
+            pending.append(segment)
+            self.next_sequence[variant] = sequence + 1
+            if variant == self.variants[0]:
+                self.produced_seconds += source['duration']
+                self.produced_bytes += source['size']
+        if self.first_segment_at is None:
+            self.first_segment_at = time.time()
+            self.record_startup()
+
+    def start_mode(self):
+        return 'filler'
+
+    def is_stalled(self):
+        return False
+
+    def stop(self, discard=False, wait=True):
+        self.stopping = True
+        self.running = False
+        if discard:
+            for pending in self.pending.values():
+                pending.clear()
+
+
+class SegmentStore:
+    def __init__(self, file_dir):
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.items = {}
+        self.file_dir = file_dir
+        self.file_ids = itertools.count(1)
+
+    def put(self, name, data, content_type, immutable=False):
+        item = {
+            'data': data,
+            'path': None,
+            'size': len(data),
+            'content_type': content_type,
+            'etag': hashlib.sha1(data).hexdigest(),
+            'last_modified': time.time(),
+            'immutable': immutable,
+        }
+        return self.insert(name, item)
+
+    def put_file(self, name, path, content_type):
+        # Only for immutable files: segment names never repeat, so the name
+        # and size make a strong validator without reading the data. The store
+        # keeps its own hard link, as ffmpeg deletes staged files on its own
+        # schedule; where linking is not possible the bytes are kept instead.
+        owned_path = os.path.join(self.file_dir, f"{next(self.file_ids)}{os.path.splitext(path)[1]}")
+        try:
+            try:
+                os.link(path, owned_path)
+            except FileNotFoundError:
+                if not os.path.exists(path):
+                    raise
+                os.makedirs(self.file_dir, exist_ok=True)
+                os.link(path, owned_path)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            with open(path, 'rb') as f:
+                return self.put(name, f.read(), content_type, immutable=True)
+        size = os.path.getsize(owned_path)
+        item = {
+            'data': None,
+            'path': os.path.abspath(owned_path),
+            'size': size,
+            'content_type': content_type,
+            'etag': hashlib.sha1(f"{name}:{size}".encode()).hexdigest(),
+            'last_modified': time.time(),
+            'immutable': True,
+        }
+        return self.insert(name, item)
+
+    def insert(self, name, item):
+        with self.lock:
+            replaced = self.items.get(name)
+            self.items[name] = item
+            self.changed.notify_all()
+        self.release(replaced)
+        return item
+
+    def release(self, item):
+        # An open sendfile keeps its data; the link just goes away.
+        if item and item['path']:
+            try:
+                os.remove(item['path'])
+            except OSError as e:
+                pass
+
+    def get(self, name):
+        with self.lock:
+            return self.items.get(name)
+
+    def discard(self, name):
+        with self.lock:
+            item = self.items.pop(name, None)
+        self.release(item)
+
+    def discard_prefix(self, prefix):
+        with self.lock:
+            discarded = [self.items.pop(name) for name in [name for name in self.items if name.startswith(prefix)]]
+        for item in discarded:
+            self.release(item)
+
+    def wake(self):
+        with self.changed:
+            self.changed.notify_all()
+
+    def wait_until(self, predicate, timeout):
+        deadline = time.monotonic() + timeout
+        with self.changed:
+            while not predicate():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or stop_event.is_set():
+                    return False
+                self.changed.wait(remaining)
+        return True
+
+    def wait_for(self, name, timeout):
+        if self.wait_until(lambda: name in self.items, timeout):
+            return self.get(name)
+        return None
+
+
+class HlsTimeline:
+    def __init__(self, root, playlist_path, list_size, store):
+        self.root = root
+        self.playlist_path = playlist_path
+        self.playlist_name = os.path.relpath(playlist_path, root).replace(os.sep, '/')
+        self.list_size = list_size
+        self.store = store
+        self.entries = deque()
+        self.retired = deque()
+        self.reset()
+
+    def reset(self):
+        for segment in itertools.chain(self.entries, self.retired):
+            self.forget(segment)
+        self.store.discard(self.playlist_name)
+        self.entries = deque()
+        self.retired = deque()
+        self.media_sequence = 0
+        self.discontinuity_sequence = 0
+        self.target_duration = HLS_TIME
+        self.discontinuity_pending = False
+        self.next_publish_at = 0.0
+        try:
+            os.remove(self.playlist_path)
+        except OSError:
+            pass
+
+    def mark_discontinuity(self):
+        if self.entries:
+            self.discontinuity_pending = True
+
+    def referenced_pipelines(self):
+        return {segment['pipeline'] for segment in itertools.chain(self.entries, self.retired)}
+
+    def publish_from(self, pending):
+        published = False
+        now = time.time()
+        while pending and now >= self.next_publish_at - PUBLISH_SLACK_SECONDS:
+            segment = pending.popleft()
+            segment_path = segment.get('path') or os.path.join(self.root, segment['uri'])
+            try:
+                if SEGMENT_SENDFILE:
+                    item = self.store.put_file(segment['uri'], segment_path, 'video/mp2t')
+                else:
+                    with open(segment_path, 'rb') as f:
+                        item = self.store.put(segment['uri'], f.read(), 'video/mp2t', immutable=True)
+            except OSError:
+                continue
+            segment['size'] = item['size']
+            segment['discontinuity'] = self.discontinuity_pending or segment.get('discontinuity', False)
+            self.discontinuity_pending = False
+            # Pre-spawned pipelines stamp their own (earlier) wall clock, so the
+            # published timeline keeps one continuous program clock instead.
+            if self.entries:
+                previous = self.entries[-1]
+                segment['program_time'] = previous['program_time'] + previous['duration']
+            else:
+                segment['program_time'] = now
+            self.append_entry(segment)
+            self.next_publish_at = max(now, self.next_publish_at) + segment['duration']
+            published = True
+        if published:
+            self.write()
+        return published
+
+    def append_entry(self, segment):
+        self.entries.append(segment)
+        self.target_duration = max(self.target_duration, int(math.ceil(segment['duration'])))
+        while len(self.entries) > self.list_size:
+            expired = self.entries.popleft()
+            self.media_sequence += 1
+            if expired['discontinuity']:
+                self.discontinuity_sequence += 1
+            self.retired.append(expired)
+        while len(self.retired) > self.list_size:
+            self.forget(self.retired.popleft())
+
+    def forget(self, segment):
+        self.store.discard(segment['uri'])
+
+    def next_program_time(self):
+        # PROGRAM-DATE-TIME of whatever is published next.
+        if not self.entries:
+            return None
+        last = self.entries[-1]
+        return last['program_time'] + last['duration']
+
+    def bandwidth(self):
+        if not self.entries:
+            return None
+        peak = max(segment['size'] * 8 / max(segment['duration'], 0.001) for segment in self.entries)
+        average = sum(segment['size'] for segment in self.entries) * 8 / max(sum(segment['duration'] for segment in self.entries), 0.001)
+        return int(peak), int(average)
+
+    def render(self):
+        lines = [
+            '#EXTM3U',
+            '#EXT-X-VERSION:3',
+            f'#EXT-X-TARGETDURATION:{self.target_duration}',
+            f'#EXT-X-MEDIA-SEQUENCE:{self.media_sequence}',
+            f'#EXT-X-DISCONTINUITY-SEQUENCE:{self.discontinuity_sequence}',
+        ]
+        for segment in self.entries:
+            if segment['discontinuity']:
+                lines.append('#EXT-X-DISCONTINUITY')
+            lines.append(f"#EXT-X-PROGRAM-DATE-TIME:{format_program_date_time(segment['program_time'])}")
+            lines.append(f"#EXTINF:{segment['duration']:.6f},")
+            lines.append(segment['uri'])
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        playlist = self.render().encode()
+        self.store.put(self.playlist_name, playlist, 'application/vnd.apple.mpegurl')
+        try:
+            write_file_atomic(self.playlist_path, playlist)
+        except OSError as e:
+            pass
+
+
+def iter_mp4_boxes(data, start=0, end=None):
+    end = len(data) if end is None else end
+    offset = start
+    while offset + 8 <= end:
+        size, box_type = struct.unpack_from('>I4s', data, offset)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', data, offset + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header:
+            return
+        yield box_type, offset + header, offset + size
+        offset += size
+
+
+def mp4_children(data, box_type, start=0, end=None):
+    return [(s, e) for t, s, e in iter_mp4_boxes(data, start, end) if t == box_type]
+
+
+def mp4_video_track(init_data):
+    video_track_id = None
+    default_flags = {}
+    for moov_start, moov_end in mp4_children(init_data, b'moov'):
+        for trak_start, trak_end in mp4_children(init_data, b'trak', moov_start, moov_end):
+            track_id = None
+            for tkhd_start, _ in mp4_children(init_data, b'tkhd', trak_start, trak_end):
+                version = init_data[tkhd_start]
+                track_id = struct.unpack_from('>I', init_data, tkhd_start + (20 if version == 1 else 12))[0]
+            for mdia_start, mdia_end in mp4_children(init_data, b'mdia', trak_start, trak_end):
+                for hdlr_start, _ in mp4_children(init_data, b'hdlr', mdia_start, mdia_end):
+                    if init_data[hdlr_start + 8:hdlr_start + 12] == b'vide' and video_track_id is None:
+                        video_track_id = track_id
+        for mvex_start, mvex_end in mp4_children(init_data, b'mvex', moov_start, moov_end):
+            for trex_start, _ in mp4_children(init_data, b'trex', mvex_start, mvex_end):
+                track_id, flags = struct.unpack_from('>I12xI', init_data, trex_start + 4)
+                default_flags[track_id] = flags
+    return video_track_id, default_flags.get(video_track_id, 0)
+
+
+def mp4_fragment_is_independent(data, video_track_id, trex_flags):
+    # A part is independent when the video track's first sample is a sync sample.
+    if video_track_id is None:
+        return True
+    for moof_start, moof_end in mp4_children(data, b'moof'):
+        for traf_start, traf_end in mp4_children(data, b'traf', moof_start, moof_end):
+            sample_flags = trex_flags
+            track_id = None
+            for tfhd_start, _ in mp4_children(data, b'tfhd', traf_start, traf_end):
+                tf_flags = struct.unpack_from('>I', data, tfhd_start)[0] & 0xFFFFFF
+                track_id = struct.unpack_from('>I', data, tfhd_start + 4)[0]
+                offset = tfhd_start + 8
+                offset += 8 if tf_flags & 0x01 else 0
+                offset += 4 if tf_flags & 0x02 else 0
+                offset += 4 if tf_flags & 0x08 else 0
+                offset += 4 if tf_flags & 0x10 else 0
+                if tf_flags & 0x20:
+                    sample_flags = struct.unpack_from('>I', data, offset)[0]
+            if track_id != video_track_id:
+                continue
+            for trun_start, _ in mp4_children(data, b'trun', traf_start, traf_end):
+                tr_flags = struct.unpack_from('>I', data, trun_start)[0] & 0xFFFFFF
+                offset = trun_start + 8
+                offset += 4 if tr_flags & 0x01 else 0
+                if tr_flags & 0x04:
+                    sample_flags = struct.unpack_from('>I', data, offset)[0]
+                elif tr_flags & 0x400:
+                    offset += 4 if tr_flags & 0x100 else 0
+                    offset += 4 if tr_flags & 0x200 else 0
+                    sample_flags = struct.unpack_from('>I', data, offset)[0]
+                return not sample_flags & 0x00010000
+    return False
+
+
+class LowLatencyTimeline(HlsTimeline):
+    def reset(self):
+        open_segment = getattr(self, 'open_segment', None)
+        if open_segment:
+            self.forget(open_segment)
+        super().reset()
+        self.open_segment = None
+        self.segment_counters = {}
+        self.part_counters = {}
+        self.init_tracks = {}
+
+    def forget(self, segment):
+        self.store.discard(segment['uri'])
+        for part in segment['parts']:
+            self.store.discard(part['uri'])
+
+    def mark_discontinuity(self):
+        self.close_segment()
+        super().mark_discontinuity()
+
+    def referenced_pipelines(self):
+        referenced = super().referenced_pipelines()
+        if self.open_segment:
+            referenced.add(self.open_segment['pipeline'])
+        return referenced
+
+    def next_program_time(self):
+        if self.open_segment:
+            return self.open_segment['program_time'] + self.open_segment['duration']
+        return super().next_program_time()
+
+    def is_independent(self, map_uri, data, map_path=None):
+        if map_uri not in self.init_tracks:
+            try:
+                with open(map_path or os.path.join(self.root, map_uri), 'rb') as f:
+                    init_data = f.read()
+            except (OSError, TypeError):
+                return True
+            self.store.put(map_uri, init_data, 'video/mp4', immutable=True)
+            self.init_tracks[map_uri] = mp4_video_track(init_data)
+        try:
+            return mp4_fragment_is_independent(data, *self.init_tracks[map_uri])
+        except struct.error:
+            return False
+
+    def part_uri(self, directory, index):
+        return f"{directory}/part{index:05d}.m4s"
+
+    def open_new_segment(self, part, now):
+        pipeline_id = part['pipeline']
+        index = self.segment_counters.get(pipeline_id, 0)
+        self.segment_counters[pipeline_id] = index + 1
+        directory = part['uri'].rsplit('/', 1)[0]
+        if self.entries:
+            previous = self.entries[-1]
+            program_time = previous['program_time'] + previous['duration']
+        else:
+            program_time = now
+        self.open_segment = {
+            'uri': f"{directory}/seg{index:05d}.m4s",
+            'directory': directory,
+            'map': part.get('map'),
+            'pipeline': pipeline_id,
+            'parts': [],
+            'data': [],
+            'duration': 0.0,
+            'discontinuity': self.discontinuity_pending,
+            'program_time': program_time,
+        }
+        self.discontinuity_pending = False
+
+    def close_segment(self):
+        segment = self.open_segment
+        self.open_segment = None
+        if not segment or not segment['parts']:
+            return
+        data = b''.join(segment.pop('data'))
+        self.store.put(segment['uri'], data, 'video/mp4', immutable=True)
+        segment['size'] = len(data)
+        self.append_entry(segment)
+
+    def publish_from(self, pending):
+        published = False
+        now = time.time()
+        while pending and now >= self.next_publish_at - PUBLISH_SLACK_SECONDS:
+            part = pending.popleft()
+            try:
+                with open(part.get('path') or os.path.join(self.root, part['uri']), 'rb') as f:
+                    data = f.read()
+            except OSError:
+                continue
+            independent = self.is_independent(part.get('map'), data, part.get('map_path'))
+            if part.get('discontinuity'):
+                self.mark_discontinuity()
+            segment = self.open_segment
+            # Segments are cut on a keyframe once they reach the target duration;
+            # a very long GOP forces a cut so the target stays bounded.
+            if segment and segment['duration'] >= HLS_TIME - 0.001 and (independent or segment['duration'] >= HLS_TIME * 2):
+                self.close_segment()
+            if self.open_segment is None:
+                self.open_new_segment(part, now)
+            segment = self.open_segment
+            # Parts are numbered per pipeline rather than per segment so the
+            # preload hint stays right even when the next part opens a segment.
+            part_index = self.part_counters.get(segment['pipeline'], 0)
+            self.part_counters[segment['pipeline']] = part_index + 1
+            part_uri = self.part_uri(segment['directory'], part_index)
+            self.store.put(part_uri, data, 'video/mp4', immutable=True)
+            segment['parts'].append({'uri': part_uri, 'duration': part['duration'], 'independent': independent})
+            segment['data'].append(data)
+            segment['duration'] += part['duration']
+            self.next_publish_at = max(now, self.next_publish_at) + part['duration']
+            published = True
+        if published:
+            self.write()
+        return published
+
+    def next_media_sequence(self):
+        return self.media_sequence + len(self.entries)
+
+    def has_media(self, msn, part=None):
+        if self.next_media_sequence() - 1 >= msn:
+            return True
+        if part is None or self.open_segment is None or msn != self.next_media_sequence():
+            return False
+        return len(self.open_segment['parts']) > part
+
+    def render(self):
+        part_target = LL_PART_TARGET * 1.1
+        lines = [
+            '#EXTM3U',
+            '#EXT-X-VERSION:9',
+            f'#EXT-X-TARGETDURATION:{self.target_duration}',
+            f'#EXT-X-SERVER-CONTROL:CAN-BLOCK-RELOAD=YES,PART-HOLD-BACK={part_target * 3:.3f}',
+            f'#EXT-X-PART-INF:PART-TARGET={part_target:.3f}',
+            f'#EXT-X-MEDIA-SEQUENCE:{self.media_sequence}',
+            f'#EXT-X-DISCONTINUITY-SEQUENCE:{self.discontinuity_sequence}',
+        ]
+        segments = list(self.entries)
+        if self.open_segment and self.open_segment['parts']:
+            segments.append(self.open_segment)
+        first_with_parts = len(segments) - LL_PARTS_WINDOW
+        current_map = None
+        for index, segment in enumerate(segments):
+            if segment['discontinuity']:
+                lines.append('#EXT-X-DISCONTINUITY')
+            if segment['map'] and segment['map'] != current_map:
+                lines.append(f'#EXT-X-MAP:URI="{segment["map"]}"')
+                current_map = segment['map']
+            lines.append(f"#EXT-X-PROGRAM-DATE-TIME:{format_program_date_time(segment['program_time'])}")
+            if index >= first_with_parts:
+                for part in segment['parts']:
+                    independent = ',INDEPENDENT=YES' if part['independent'] else ''
+                    lines.append(f'#EXT-X-PART:DURATION={part["duration"]:.5f},URI="{part["uri"]}"{independent}')
+            if segment is not self.open_segment:
+                lines.append(f"#EXTINF:{segment['duration']:.6f},")
+                lines.append(segment['uri'])
+        if self.open_segment:
+            next_part = self.part_uri(self.open_segment['directory'], self.part_counters.get(self.open_segment['pipeline'], 0))
+            lines.append(f'#EXT-X-PRELOAD-HINT:TYPE=PART,URI="{next_part}"')
+        return '\n'.join(lines) + '\n'
+
+
+class HlsOutput:
+    def __init__(self, variants, store, root):
+        self.variants = variants
+        self.store = store
+        self.abr = variants != ['main']
+        self.master_path = os.path.join(root, HLS_OUTPUT_NAME)
+        self.master_name = HLS_OUTPUT_NAME
+        self.master_bandwidths = None
+        timeline_class = LowLatencyTimeline if LOW_LATENCY else HlsTimeline
+        if self.abr:
+            self.timelines = {variant: timeline_class(root, os.path.join(root, f'stream_{variant}.m3u8'), HLS_LIST_SIZE, store) for variant in variants}
+        else:
+            self.timelines = {'main': timeline_class(root, self.master_path, HLS_LIST_SIZE, store)}
+
+    def reset(self):
+        for timeline in self.timelines.values():
+            timeline.reset()
+        if self.abr:
+            self.master_bandwidths = None
+            self.store.discard(self.master_name)
+
+    def mark_discontinuity(self):
+        for timeline in self.timelines.values():
+            timeline.mark_discontinuity()
+
+    def referenced_pipelines(self):
+        referenced = set()
+        for timeline in self.timelines.values():
+            referenced |= timeline.referenced_pipelines()
+        return referenced
+
+    def publish_from(self, pipeline):
+        published = False
+        for variant, timeline in self.timelines.items():
+            pending = pipeline.pending[variant]
+            queued_seconds = sum(segment['duration'] for segment in pending)
+            published = timeline.publish_from(pending) or published
+            if variant == self.variants[0]:
+                pipeline.published_seconds += queued_seconds - sum(segment['duration'] for segment in pending)
+        if published and self.abr:
+            self.update_master()
+        return published
+
+    def timeline_for(self, playlist_name):
+        for timeline in self.timelines.values():
+            if timeline.playlist_name == playlist_name:
+                return timeline
+        return None
+
+    def next_due(self, pipeline):
+        due = [timeline.next_publish_at for variant, timeline in self.timelines.items() if pipeline.pending[variant]]
+        return min(due) if due else None
+
+    def next_program_time(self):
+        return self.timelines[self.variants[0]].next_program_time()
+
+    def update_master(self):
+        bandwidths = {variant: timeline.bandwidth() for variant, timeline in self.timelines.items()}
+        if not all(bandwidths.values()):
+            return
+        # Only rewrite the master when a peak grows noticeably, so players are
+        # not handed a fresh ETag every segment.
+        if self.master_bandwidths and all(bandwidths[v][0] <= self.master_bandwidths[v][0] * 1.1 for v in self.variants):
+            return
+        self.master_bandwidths = bandwidths
+        lines = ['#EXTM3U', '#EXT-X-VERSION:3']
+        for variant in self.variants:
+            peak, average = bandwidths[variant]
+            lines.append(f'#EXT-X-STREAM-INF:BANDWIDTH={peak},AVERAGE-BANDWIDTH={average}')
+            lines.append(os.path.basename(self.timelines[variant].playlist_path))
+        playlist = ('\n'.join(lines) + '\n').encode()
+        self.store.put(self.master_name, playlist, 'application/vnd.apple.mpegurl')
+        try:
+            write_file_atomic(self.master_path, playlist)
+        except OSError as e:
+            pass
+
+
+media_audio_cache = {}
+
+
+def probe_has_audio(video_path):
+    if video_path not in media_audio_cache:
+        try:
+            result = subprocess.run(
+                ['ffprobe', '-v', 'error', '-select_streams', 'a', '-show_entries', 'stream=index', '-of', 'csv=p=0', video_path],
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=30, text=True)
+            media_audio_cache[video_path] = bool(result.stdout.strip())
+        except Exception as e:
+            return True
+    return media_audio_cache[video_path]
+
+
+def rendition_encoding_options(index, name, has_audio, audio_copy=False):
+    options = ['-map', '0:v:0']
+    if has_audio:
+        options.extend(['-map', '0:a:0'])
+    rendition = ABR_RENDITIONS[name]
+    audio_kbps = 128
+    if rendition is None:
+        options.extend([f'-c:v:{index}', 'copy'])
+    else:
+        height, video_kbps, audio_kbps = rendition
+        options.extend([
+            f'-filter:v:{index}', f'scale=-2:{height}',
+            f'-c:v:{index}', 'libx264',
+            f'-preset:v:{index}', ABR_PRESET,
+            f'-b:v:{index}', f'{video_kbps}k',
+            f'-maxrate:v:{index}', f'{video_kbps}k',
+            f'-bufsize:v:{index}', f'{video_kbps * 2}k',
+        ])
+    if has_audio and audio_copy:
+        options.extend([f'-c:a:{index}', 'copy'])
+    elif has_audio:
+        options.extend([f'-c:a:{index}', 'aac', f'-b:a:{index}', f'{audio_kbps}k'])
+    return options
+
+
+def abr_encoding_options(ladder, has_audio, audio_copy=False):
+    options = []
+    for index, name in enumerate(ladder):
+        options.extend(rendition_encoding_options(index, name, has_audio, audio_copy))
+    # Transcoded renditions cut keyframes on the segment grid so they stay switchable.
+    options.extend([
+        '-force_key_frames', f'expr:gte(t,n_forced*{HLS_TIME})',
+        '-sc_threshold', '0',
+    ])
+    if not audio_copy:
+        options.extend(['-ac', '2', '-ar', '44100'])
+    return options
+
+
+def abr_stream_map(ladder, has_audio):
+    return ' '.join(f'v:{index},a:{index},name:{name}' if has_audio else f'v:{index},name:{name}'
+                    for index, name in enumerate(ladder))
+
+
+def process_cpu_seconds(pid):
+    try:
+        with open(f'/proc/{pid}/stat', 'r') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def measure_rendition_cost(video_path, name, seconds, has_audio):
+    command = ['ffmpeg', '-v', 'error', '-t', str(seconds), '-i', video_path]
+    command += rendition_encoding_options(0, name, has_audio)
+    command += ['-ac', '2', '-ar', '44100', '-f', 'null', '-']
+    started = time.monotonic()
+    # Niced like ingest: the measurement shares the CPU with the live pipelines.
+    preexec_fn = (lambda: os.nice(10)) if hasattr(os, 'nice') else None
+    try:
+        process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, preexec_fn=preexec_fn)
+    except Exception as e:
+        return {'rendition': name, 'error': 'ffmpeg could not be started'}
+    cpu_seconds = None
+    if os.name == 'nt':
+        process.wait()
+    else:
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        cpu_seconds = usage.ru_utime + usage.ru_stime
+    wall_seconds = time.monotonic() - started
+    return {
+        'rendition': name,
+        'exit_code': process.returncode,
+        'cpu_seconds': round(cpu_seconds, 3) if cpu_seconds is not None else None,
+        'wall_seconds': round(wall_seconds, 3),
+        # CPU seconds per second of media == cores needed to keep up in real time.
+        'cores_at_realtime': round(cpu_seconds / seconds, 3) if cpu_seconds is not None else None,
+    }
+
+
+def prepare_stream_output(output_dir):
+    try:
+        shutil.rmtree(output_dir, ignore_errors=True)
+        for variant in STREAM_VARIANTS:
+            os.makedirs(os.path.join(output_dir, variant), exist_ok=True)
+    except Exception as e:
+        pass
+
+
+def push_target(url):
+    # The name is what status and metrics show: stream keys sit in the last
+    # path element or the query, so it keeps neither.
+    if not isinstance(url, str):
+        return None
+    url = url.strip()
+    parsed = urlparse(url)
+    muxer = PUSH_FORMATS.get(parsed.scheme.lower())
+    host = parsed.netloc.rsplit('@', 1)[-1]
+    if not muxer or not host:
+        return None
+    if muxer == 'mpegts' and 'pkt_size' not in dict(parse_qsl(parsed.query)):
+        # Seven TS packets per datagram.
+        url += ('&' if parsed.query else '?') + 'pkt_size=1316'
+    path = parsed.path.rstrip('/')
+    name = f"{parsed.scheme.lower()}://{host}" + (path.rsplit('/', 1)[0] + '/***' if path else '')
+    return {'url': url, 'format': muxer, 'name': name}
+
+
+def tee_escape(value, specials):
+    return re.sub('([\\\\\'' + re.escape(specials) + '])', r'\\\1', value)
+
+
+def tee_slave(options, url):
+    # tee unescapes twice: splitting the outputs on "|", then each output's
+    # [key=value:...] list.
+    spec = ':'.join(f"{key}={tee_escape(str(value), ':')}" for key, value in options)
+    return tee_escape(f'[{spec}]{url}', '|')
+
+
+def tee_output_options(hls_options, playlist_path, push_targets, has_audio):
+    # Output #0 is the HLS muxer and aborts the run if it fails; every push
+    # target gets its own fifo thread so a slow ingest cannot hold it up.
+    slaves = [tee_slave([('f', 'hls')] + hls_options, playlist_path)]
+    for target in push_targets:
+        options = [('f', target['format']), ('onfail', 'ignore'), ('use_fifo', 1)]
+        if ABR_LADDER:
+            # Targets take the first rendition of the ladder.
+            options.append(('select', 'v:0,a:0' if has_audio else 'v:0'))
+        if target['format'] == 'flv':
+            options.append(('flvflags', 'no_duration_filesize'))
+        slaves.append(tee_slave(options, target['url']))
+    # flv wants the encoders' parameter sets in its header; the TS muxers
+    # still repeat them in-band on every keyframe.
+    options = ['-flags', '+global_header'] if ABR_LADDER else []
+    if any(target['format'] == 'flv' for target in push_targets):
+        # Stream copies keep the mp4 tags (avc1, mp4a), which flv refuses; the
+        # HLS muxers pick their own tags either way.
+        options += ['-tag:v', '7', '-tag:a', '10']
+    return options + ['-fifo_options', f'queue_size={PUSH_QUEUE_SIZE}', '-f', 'tee', '|'.join(slaves)]
+
+
+def ffmpeg_stream_command(abs_video_path, output_dir, loop=False, stream_ready=False, progressive=False, start_offset=0.0, vod=False,
+                          push_targets=()):
+    # vod cuts the whole file as fast as it can into a complete playlist
+    # instead of feeding a live one in real time.
+    ffmpeg_command_base = [
+        'ffmpeg',
+        '-hide_banner',
+        '-nostats',
+        '-loglevel', 'warning',
+    ]
+    if not vod:
+        ffmpeg_command_base.extend(['-progress', 'pipe:1', '-re'])
+
+    if loop:
+        ffmpeg_command_base.extend(['-stream_loop', '-1'])
+
+    if progressive:
+        ffmpeg_command_base.extend([
+            '-reconnect', '1',
+            '-reconnect_streamed', '1',
+            '-reconnect_on_network_error', '1',
+            '-reconnect_delay_max', '5',
+            '-rw_timeout', str(int(PROGRESSIVE_START_TIMEOUT * 1000000)),
+        ])
+
+    if start_offset:
+        ffmpeg_command_base.extend(['-ss', f'{start_offset:.3f}'])
+
+    ffmpeg_command_base.extend(['-i', abs_video_path])
+
+    has_audio = None
+    if ABR_LADDER:
+        has_audio = probe_has_audio(abs_video_path)
+        ffmpeg_command_options = abr_encoding_options(ABR_LADDER, has_audio, audio_copy=stream_ready)
+        variant_dir = '%v'
+    else:
+        # tee picks no streams by itself.
+        ffmpeg_command_options = ['-map', '0:v:0?', '-map', '0:a:0?'] if push_targets else []
+        if stream_ready:
+            ffmpeg_command_options += ['-c', 'copy']
+        else:
+            ffmpeg_command_options += [
+                '-c:v', 'copy',
+                '-c:a', 'aac',
+                '-b:a', '128k',
+                '-ac', '2',
+                '-ar', '44100',
+            ]
+        variant_dir = 'main'
+
+    hls_flags = 'temp_file' if vod else 'delete_segments+omit_endlist+program_date_time+temp_file'
+    hls_options = []
+    if LOW_LATENCY:
+        # ffmpeg cannot emit EXT-X-PART itself, so it writes part-sized fMP4
+        # fragments (cut off-keyframe) and the timeline groups them into segments.
+        hls_options += [
+            ('hls_segment_type', 'fmp4'),
+            ('hls_fmp4_init_filename', 'init.mp4'),
+        ]
+        hls_flags += '+split_by_time'
+        segment_filename = 'chunk%05d.m4s'
+    else:
+        segment_filename = 'segment%05d.ts'
+
+    hls_options.append(('hls_time', str(STAGING_UNIT_SECONDS)))
+    if vod:
+        hls_options += [('hls_list_size', '0'), ('hls_playlist_type', 'vod')]
+    else:
+        hls_options += [('hls_list_size', str(STAGING_LIST_SIZE)), ('hls_delete_threshold', str(STAGING_DELETE_THRESHOLD))]
+    hls_options += [
+        ('hls_flags', hls_flags),
+        ('hls_segment_filename', os.path.join(output_dir, variant_dir, segment_filename)),
+    ]
+    if ABR_LADDER:
+        hls_options.append(('var_stream_map', abr_stream_map(ABR_LADDER, has_audio)))
+    playlist_path = os.path.join(output_dir, variant_dir, 'index.m3u8')
+
+    ffmpeg_command_options += [
+        '-err_detect', 'ignore_err',
+        '-ignore_unknown',
+    ]
+    if push_targets:
+        ffmpeg_command_options += tee_output_options(hls_options, playlist_path, push_targets, has_audio)
+    else:
+        ffmpeg_command_options += ['-f', 'hls']
+        for key, value in hls_options:
+            ffmpeg_command_options += [f'-{key}', value]
+        ffmpeg_command_options.append(playlist_path)
+
+    return ffmpeg_command_base + ffmpeg_command_options
+
+
+def start_ffmpeg_stream(video_path, output_dir, loop=False, stream_ready=False, progressive=False, start_offset=0.0, push_targets=()):
+    if progressive:
+        abs_video_path = video_path
+    else:
+        abs_video_path = os.path.abspath(video_path)
+        if not os.path.exists(abs_video_path):
+            return None
+
+    prepare_stream_output(output_dir)
+    ffmpeg_command = ffmpeg_stream_command(abs_video_path, output_dir, loop=loop, stream_ready=stream_ready,
+                                           progressive=progressive, start_offset=start_offset, push_targets=push_targets)
+
+    try:
+        # stdout carries -progress and stderr the warnings; the pipeline drains both.
+        return subprocess.Popen(ffmpeg_command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                text=True, errors='replace')
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        return None
+
+
+def filler_directory(source_path, stream_ready):
+    # One set per source file and output format; channels with the same
+    # default share it, and VideoCache.drop removes it with the source.
+    digest = os.path.basename(source_path).split('.', 1)[0]
+    signature = hashlib.sha1(json.dumps([HLS_MODE, STAGING_UNIT_SECONDS, ABR_LADDER, stream_ready]).encode()).hexdigest()[:8]
+    return os.path.join(FILLER_DIR, f"{digest}-{signature}")
+
+
+def load_filler(directory):
+    filler = {}
+    for variant in STREAM_VARIANTS:
+        variant_dir = os.path.join(directory, variant)
+        try:
+            with open(os.path.join(variant_dir, 'index.m3u8'), 'r') as f:
+                text = f.read()
+        except OSError:
+            return None
+        if '#EXT-X-ENDLIST' not in text:
+            return None
+        segments = []
+        for segment in parse_media_playlist(text)[1]:
+            path = os.path.join(variant_dir, segment['uri'])
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                return None
+            segments.append({'path': path, 'duration': segment['duration'], 'size': size,
+                             'map_path': os.path.join(variant_dir, segment['map']) if 'map' in segment else None})
+        if not segments:
+            return None
+        filler[variant] = segments
+    # Renditions are replayed side by side, so every pass must be the same length.
+    count = min(len(segments) for segments in filler.values())
+    return {variant: segments[:count] for variant, segments in filler.items()}
+
+
+def build_filler(source_path, stream_ready):
+    directory = filler_directory(source_path, stream_ready)
+    with filler_lock:
+        filler = load_filler(directory)
+        if filler or stop_event.is_set():
+            return filler
+        staging_dir = f"{directory}.tmp"
+        prepare_stream_output(staging_dir)
+        command = ffmpeg_stream_command(os.path.abspath(source_path), staging_dir, stream_ready=stream_ready, vod=True)
+        try:
+            process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except Exception as e:
+            return None
+        while process.poll() is None:
+            if stop_event.wait(1):
+                stop_process(process)
+        if process.returncode == 0 and load_filler(staging_dir):
+            shutil.rmtree(directory, ignore_errors=True)
+            os.replace(staging_dir, directory)
+            return load_filler(directory)
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        return None
 
-app = Flask(__name__)
-CORS(app)
-app.secret_key = os.urandom(24)
 
-os.makedirs(VIDEO_DIR, exist_ok=True)
-os.makedirs(STREAM_OUTPUT_DIR, exist_ok=True)
+class Channel:
+    def __init__(self, name, default_url, push_targets=()):
+        self.name = name
+        self.default_url = canonical_url(default_url)
+        self.push_targets = [target for target in map(push_target, push_targets) if target]
+        self.push_failure_count = [0] * len(self.push_targets)
+        self.is_main = name == MAIN_CHANNEL
+        self.output_dir = STREAM_OUTPUT_DIR if self.is_main else os.path.join(STREAM_OUTPUT_DIR, name)
+        self.live_dir = os.path.join(self.output_dir, LIVE_DIR_NAME)
+        self.journal_path = QUEUE_DB_PATH if self.is_main else os.path.join(CHANNEL_DATA_DIR, f'{name}.db')
+        self.lock = threading.Lock()
+        self.scheduler_event = threading.Event()
+        self.closed = threading.Event()
+        self.journal, self.queue, self.played = restore_queue(self.journal_path, name, self.default_url)
+        self.resume_offsets = {canonical_url(url): offset for url, offset in self.journal.resume.items() if canonical_url(url) in self.queue}
+        self.schedule = []
+        for entry in self.journal.schedule:
+            if valid_start_at(entry['start_at']):
+                self.schedule.append(dict(entry, url=canonical_url(entry['url'])))
+            else:
+                self.journal.record('schedule_remove', entry['id'])
+        self.store = SegmentStore(os.path.join(self.live_dir, STORE_DIR_NAME))
+        self.hls_output = HlsOutput(STREAM_VARIANTS, self.store, self.output_dir)
+        self.on_air = None
+        self.standby = None
+        self.default_video_path = None
+        self.filler = None
+        self.thread = None
+        self.pending_restart = None
+        self.restart_count = 0
+        self.stall_count = 0
+        self.segment_latency = Histogram(SEGMENT_LATENCY_BUCKETS)
 
-def ensure_dropbox_raw_param(url):
-    try:
-        if not url or not (url.startswith('http://') or url.startswith('https://')):
-            return url
+    @property
+    def currently_playing_url(self):
+        return self.on_air.url if self.on_air else None
 
-        parsed_url = urlparse(url)
+    def notify(self):
+        self.scheduler_event.set()
 
-        if parsed_url.netloc.lower() == 'www.dropbox.com' or parsed_url.netloc.lower() == 'dropbox.com':
-            query_params = parse_qs(parsed_url.query)
-
-            if not ('raw' in query_params and query_params['raw'] == ['1']):
-                query_params['raw'] = ['1']
-                new_query = urlencode(query_params, doseq=True)
-                modified_url = urlunparse((
-                    parsed_url.scheme,
-                    parsed_url.netloc,
-                    parsed_url.path,
-                    parsed_url.params,
-                    new_query,
-                    parsed_url.fragment
-                ))
-                return modified_url
-            else:
-                 return url
-        else:
-            return url
-    except Exception as e:
-        # Error logging removed as requested
-        return url
+    def is_active(self):
+        return not stop_event.is_set() and not self.closed.is_set()
 
+    def start(self):
+        self.journal.start()
+        self.thread = threading.Thread(target=self.run, name=f"StreamManager-{self.name}", daemon=True)
+        self.thread.start()
 
-def get_safe_filename(url):
-    try:
-        parsed_url = urlparse(url)
-        path_part = parsed_url.path
-        base_name = os.path.basename(path_part)
-        _, ext = os.path.splitext(base_name)
+    def close(self, timeout=10):
+        self.closed.set()
+        self.notify()
+        if self.thread and self.thread.is_alive():
+            self.thread.join(timeout=timeout)
+        self.stop_stream()
+        self.journal.close()
 
-        hashed_url = hashlib.sha1(url.encode()).hexdigest()[:10]
+    def stop_stream(self):
+        with self.lock:
+            pipelines = [p for p in (self.on_air, self.standby) if p]
+        for pipeline in pipelines:
+            pipeline.stop()
 
-        if not ext or len(ext) > 5:
-             ext = '.mp4'
+    def drop_queue_head(self, url):
+        with self.lock:
+            if self.queue and self.queue[0] == url:
+                self.queue.popleft()
+                return True
+        return False
 
-        if ext.lower() not in ['.mp4', '.ts', '.mkv', '.avi', '.mov', '.wmv', '.flv', '.m3u8']:
-             ext = '.mp4'
+    def protected_video_paths(self):
+        with self.lock:
+            paths = [p.video_path for p in (self.on_air, self.standby) if p]
+            upcoming_urls = self.scheduled_urls() + list(itertools.islice(self.queue, PREFETCH_DEPTH))
+        if self.default_video_path:
+            paths.append(self.default_video_path)
+        for url in upcoming_urls:
+            path = video_cache.lookup(url)
+            if path:
+                paths.append(path)
+        return paths
 
-        return f"video_{hashed_url}{ext}"
-    except Exception as e:
-        # Error logging removed as requested
-        hashed_url = hashlib.sha1(url.encode()).hexdigest()[:10]
-        return f"video_{hashed_url}.mp4"
+    def launch_next_pipeline(self, blocking):
+        # Non-blocking launches (pre-spawns) never wait on a download; the queue
+        # head keeps prefetching in the background while the current item plays.
+        with self.lock:
+            play_url = self.queue[0] if self.queue else None
 
+        pipeline = None
+        if play_url:
+            filename = get_safe_filename(play_url)
+            next_video_path = video_cache.lookup(play_url)
+            progressive = False
+            if next_video_path is None:
+                if download_manager.has_failed(filename):
+                    self.drop_queue_head(play_url)
+                    download_manager.forget(filename)
+                    return None
+                if PROGRESSIVE_START and progressive_allowed(play_url):
+                    next_video_path, progressive = play_url, True
+                elif blocking and not self.default_video_path:
+                    next_video_path = download_manager.fetch(play_url, filename)
+                    if not next_video_path:
+                        self.drop_queue_head(play_url)
+                        return None
+            ready_path = video_cache.ready_path(play_url) if next_video_path and not progressive else None
+            if next_video_path and not ready_path and not blocking and ingest_manager.should_wait(play_url):
+                # A pre-spawn can afford to hold off for the ingest; a handoff cannot.
+                return None
+            if next_video_path:
+                if not self.drop_queue_head(play_url):
+                    return None
+                with self.lock:
+                    resume_at = self.resume_offsets.pop(play_url, 0.0)
+                pipeline = HlsPipeline(self, play_url, ready_path or next_video_path, stream_ready=bool(ready_path), progressive=progressive,
+                                       start_offset=seek_offset(ready_path or next_video_path, resume_at))
+            elif not blocking:
+                return None
 
-def download_video(url, output_filename):
-    filepath = os.path.join(VIDEO_DIR, output_filename)
-    try:
-        if os.path.exists(filepath):
-            try:
-                if os.path.getsize(filepath) > 0:
-                    return filepath
-                # else: print removed
-            except OSError as e:
-                 # print removed
-                 pass # Continue to download
+        if pipeline is None:
+            if not self.default_video_path:
+                return None
+            ready_path = video_cache.ready_path(self.default_url)
+            if self.filler:
+                pipeline = FillerPipeline(self, self.default_url, ready_path or self.default_video_path, self.filler)
+            else:
+                pipeline = HlsPipeline(self, self.default_url, ready_path or self.default_video_path, loop=True, stream_ready=bool(ready_path))
 
-        headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
-        response = requests.get(url, stream=True, timeout=60, headers=headers, allow_redirects=True)
-        response.raise_for_status()
+        if not pipeline.start():
+            pipeline.remove_output()
+            return None
+        return pipeline
 
-        content_type = response.headers.get('content-type', '').lower()
-        problematic_types = ['text/html', 'application/json']
-        is_likely_video = 'video' in content_type or 'mpegurl' in content_type or 'octet-stream' in content_type or not any(ptype in content_type for ptype in problematic_types)
+    def filler_source(self):
+        ready_path = video_cache.ready_path(self.default_url)
+        return ready_path or self.default_video_path, bool(ready_path)
 
-        if not is_likely_video:
-             if 'dropbox.com' in url and 'raw=1' not in url:
-                 # print removed
-                 pass
+    def prepare_filler(self):
+        # Until the cut is done the default loops through ffmpeg as before.
+        while ingest_manager.should_wait(self.default_url) and self.is_active():
+            self.closed.wait(1)
+        if self.is_active():
+            self.filler = build_filler(*self.filler_source())
+            self.notify()
 
-        with open(filepath, "wb") as f:
-            downloaded_size = 0
-            for chunk in response.iter_content(chunk_size=8192 * 4):
-                if stop_event.is_set():
-                    if os.path.exists(filepath): os.remove(filepath)
-                    return None
-                if chunk:
-                    f.write(chunk)
-                    downloaded_size += len(chunk)
+    def launch_scheduled(self, entry, make_way_for=None):
+        with self.lock:
+            if entry not in self.schedule:
+                return None
+        play_url = entry['url']
+        filename = get_safe_filename(play_url)
+        video_path = video_cache.lookup(play_url)
+        progressive = False
+        if video_path is None:
+            if download_manager.has_failed(filename):
+                with self.lock:
+                    self.remove_scheduled(entry['id'])
+                download_manager.forget(filename)
+                return None
+            if not PROGRESSIVE_START or not progressive_allowed(play_url):
+                return None
+            video_path, progressive = play_url, True
+        ready_path = video_cache.ready_path(play_url) if not progressive else None
+        # Joins in progress if it should already be on air.
+        late = time.time() - entry['start_at']
+        if not ready_path and not progressive and late < 0 and ingest_manager.should_wait(play_url):
+            return None
+        pipeline = HlsPipeline(self, play_url, ready_path or video_path, stream_ready=bool(ready_path), progressive=progressive,
+                               start_offset=seek_offset(ready_path or video_path, late))
+        pipeline.schedule_entry = entry
+        if make_way_for:
+            self.make_way(make_way_for)
+        if not pipeline.start():
+            pipeline.remove_output()
+            return None
+        with self.lock:
+            self.remove_scheduled(entry['id'])
+        return pipeline
 
-        if downloaded_size == 0:
-             if os.path.exists(filepath): os.remove(filepath)
-             return None
+    def scheduled_urls(self):
+        # Caller holds self.lock.
+        horizon = time.time() + SCHEDULE_PREFETCH_SECONDS
+        return [entry['url'] for entry in self.schedule if entry['start_at'] <= horizon]
 
-        return filepath
+    def add_scheduled(self, url, start_at):
+        entry = {'id': uuid.uuid4().hex[:12], 'url': url, 'start_at': start_at}
+        with self.lock:
+            self.insert_scheduled(entry)
+        self.notify()
+        return entry
 
-    except requests.exceptions.Timeout:
-        if os.path.exists(filepath): os.remove(filepath)
-        return None
-    except requests.exceptions.SSLError as e:
-        if os.path.exists(filepath): os.remove(filepath)
-        return None
-    except requests.exceptions.RequestException as e:
-        if os.path.exists(filepath): os.remove(filepath)
-        return None
-    except Exception as e:
-        if os.path.exists(filepath): os.remove(filepath)
+    def insert_scheduled(self, entry):
+        # Caller holds self.lock.
+        self.schedule.append(entry)
+        self.schedule.sort(key=lambda e: e['start_at'])
+        self.journal.record('schedule_add', entry['id'], entry['url'], entry['start_at'])
+        event_bus.publish('schedule', dict(entry, channel=self.name, op='add'))
+
+    def remove_scheduled(self, entry_id):
+        # Caller holds self.lock.
+        for entry in self.schedule:
+            if entry['id'] == entry_id:
+                self.schedule.remove(entry)
+                self.journal.record('schedule_remove', entry_id)
+                event_bus.publish('schedule', dict(entry, channel=self.name, op='remove'))
+                return entry
         return None
 
-def stop_ffmpeg_stream():
-    global current_ffmpeg_process
-    with stream_lock:
-        process_to_stop = current_ffmpeg_process
-        if process_to_stop and process_to_stop.poll() is None:
-            try:
-                if os.name == 'nt':
-                    subprocess.run(['taskkill', '/F', '/PID', str(process_to_stop.pid)], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                else:
-                    process_to_stop.terminate()
-                    try:
-                        process_to_stop.wait(timeout=5)
-                    except subprocess.TimeoutExpired:
-                        process_to_stop.kill()
-                        process_to_stop.wait()
-            except Exception as e:
-                # Error logging removed
-                pass
-        # elif process_to_stop: print removed
-        # else: print removed
+    def schedule_reached(self, start_at):
+        # The switch lands on the publish boundary nearest the scheduled time,
+        # as stamped in PROGRAM-DATE-TIME.
+        next_program_time = self.hls_output.next_program_time() or time.time()
+        return next_program_time + STAGING_UNIT_SECONDS / 2 >= start_at
 
-        if current_ffmpeg_process == process_to_stop:
-             current_ffmpeg_process = None
+    def is_due(self, pipeline):
+        return pipeline.schedule_entry is None or self.schedule_reached(pipeline.schedule_entry['start_at'])
 
+    def make_way(self, pipeline):
+        with self.lock:
+            self.requeue_interrupted(pipeline)
+        pipeline.stop(discard=True)
 
-def start_ffmpeg_stream(video_path, loop=False):
-    global current_ffmpeg_process
+    def requeue_interrupted(self, pipeline):
+        # Caller holds self.lock. The item goes back to the head of the queue
+        # and later resumes from what viewers last saw of it.
+        pipeline.cancelled = True
+        position = pipeline.playback_position()
+        pipeline.publish('interrupted', position=position)
+        if pipeline.loop:
+            return
+        if position > 0:
+            self.resume_offsets[pipeline.url] = position
+        self.queue.appendleft(pipeline.url)
 
-    abs_video_path = os.path.abspath(video_path)
-    if not os.path.exists(abs_video_path):
-        return None
+    def abandon_progressive_start(self, pipeline):
+        # The URL goes back to the head of the queue (or the schedule) and
+        # waits for the full download.
+        progressive_start_failed(pipeline.url)
+        pipeline.stop(discard=True, wait=False)
+        pipeline.publish('abandoned')
+        with self.lock:
+            if pipeline.schedule_entry:
+                self.insert_scheduled(pipeline.schedule_entry)
+            else:
+                self.queue.appendleft(pipeline.url)
+        self.notify()
 
-    stop_ffmpeg_stream()
-    # time.sleep removed
+    def schedule_restart(self, pipeline):
+        attempt = 0 if pipeline.produced_seconds >= FFMPEG_HEALTHY_SECONDS else pipeline.restarts
+        if not pipeline.loop and attempt >= FFMPEG_MAX_RESTARTS:
+            pipeline.publish('failed', restarts=pipeline.restarts, stderr=list(pipeline.stderr_tail))
+            return
+        delay = min(FFMPEG_RESTART_MAX_DELAY, FFMPEG_RESTART_DELAY * 2 ** attempt)
+        self.pending_restart = (pipeline, time.time() + delay, attempt + 1)
 
-    try:
-        if os.path.exists(STREAM_OUTPUT_DIR):
-             deleted_count = 0
-             for f in os.listdir(STREAM_OUTPUT_DIR):
-                 if f.endswith('.ts') or f.endswith('.m3u8'):
-                     try:
-                         os.remove(os.path.join(STREAM_OUTPUT_DIR, f))
-                         deleted_count += 1
-                     except OSError as e:
-                         # Error logging removed
-                         pass
-             # if deleted_count > 0: print removed
+    def restart_pipeline(self, failed, attempt):
+        # Picks the best source available now: the cache may have caught up
+        # with a progressive start since it failed.
+        self.restart_count += 1
+        ready_path = video_cache.ready_path(failed.url)
+        video_path = ready_path or video_cache.lookup(failed.url) or failed.video_path
+        pipeline = HlsPipeline(self, failed.url, video_path, loop=failed.loop, stream_ready=bool(ready_path),
+                               progressive=video_path == failed.url,
+                               start_offset=seek_offset(video_path, failed.resume_position()),
+                               restarts=attempt)
+        pipeline.duration = failed.duration
+        if not pipeline.start():
+            pipeline.remove_output()
+            self.schedule_restart(pipeline)
+            return None
+        return pipeline
+
+    def begin_transition(self):
+        if GAPLESS_TRANSITIONS:
+            self.hls_output.mark_discontinuity()
         else:
-             os.makedirs(STREAM_OUTPUT_DIR, exist_ok=True)
-    except Exception as e:
-        # Error logging removed
-        pass
+            self.hls_output.reset()
 
+    def run(self):
+        reset_stream_output(self.output_dir)
 
-    ffmpeg_command_base = [
-        'ffmpeg',
-        '-re',
-    ]
+        temp_default_path = download_manager.fetch(self.default_url, get_safe_filename(self.default_url))
+        if temp_default_path:
+             self.default_video_path = temp_default_path
+             ingest_manager.submit(self.default_url)
+             # Pushed outputs need the default to keep flowing through ffmpeg.
+             if PRESEGMENTED_FILLER and not self.push_targets:
+                 self.filler = load_filler(filler_directory(*self.filler_source()))
+                 if self.filler is None:
+                     threading.Thread(target=self.prepare_filler, name=f"Filler-{self.name}", daemon=True).start()
+        # else: print removed
 
-    if loop:
-        ffmpeg_command_base.extend(['-stream_loop', '-1'])
+        retired_pipelines = []
+        announced = None
+        gapless = GAPLESS_TRANSITIONS and not self.push_targets
+        prespawn_lead = 0 if self.push_targets else PRESPAWN_LEAD_SECONDS
 
-    ffmpeg_command_base.extend(['-i', abs_video_path])
+        while self.is_active():
+            try:
+                with self.lock:
+                    on_air = self.on_air
+                    standby = self.standby
+                    queue_waiting = bool(self.queue)
+                    scheduled = self.schedule[0] if self.schedule else None
+                    upcoming_urls = self.scheduled_urls() + list(itertools.islice(self.queue, PREFETCH_DEPTH))
 
-    ffmpeg_command_options = [
-        '-c:v', 'copy',
-        '-c:a', 'aac',
-        '-b:a', '128k',
-        '-ac', '2',
-        '-ar', '44100',
-        '-err_detect', 'ignore_err',
-        '-ignore_unknown',
-        '-f', 'hls',
-        '-hls_time', '4',
-        '-hls_list_size', '6',
-        '-hls_flags', 'delete_segments+omit_endlist+program_date_time',
-        '-hls_segment_filename', os.path.join(STREAM_OUTPUT_DIR, 'segment%05d.ts'),
-        HLS_OUTPUT_FILE
-    ]
+                download_manager.prefetch(upcoming_urls)
 
-    ffmpeg_command = ffmpeg_command_base + ffmpeg_command_options
+                # A warm default filler is useless once something real is queued.
+                if standby and standby.loop and queue_waiting:
+                    standby.cancelled = True
 
-    # print command removed
+                if standby and not standby.cancelled and standby.start_failed():
+                    self.abandon_progressive_start(standby)
+                    standby.cancelled = True
 
-    try:
-        # Redirect stderr to DEVNULL to suppress FFmpeg messages
-        process = subprocess.Popen(ffmpeg_command, stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+                if standby and standby.cancelled:
+                    standby.stop(discard=True, wait=False)
+                    retired_pipelines.append(standby)
+                    standby = None
 
-        # stderr logging thread removed
+                # A scheduled item takes the standby slot ahead of its start time;
+                # whatever was pre-spawned there goes back to the queue.
+                if scheduled and scheduled['start_at'] - prespawn_lead <= time.time() and not (standby and standby.schedule_entry):
+                    # The item on air lets go of the push targets just before
+                    # the scheduled one connects to them.
+                    pushing = self.push_targets and on_air and on_air.is_running()
+                    pipeline = self.launch_scheduled(scheduled, make_way_for=on_air if pushing else None)
+                    if pipeline:
+                        if standby:
+                            with self.lock:
+                                self.requeue_interrupted(standby)
+                            standby.stop(discard=True, wait=False)
+                            retired_pipelines.append(standby)
+                        standby = pipeline
 
-        with stream_lock:
-            current_ffmpeg_process = process
-        return process
+                if standby:
+                    standby.poll_segments()
+                    if standby.is_stalled():
+                        standby.mark_stalled()
 
-    except FileNotFoundError:
-        with stream_lock: current_ffmpeg_process = None
-        return None
-    except Exception as e:
-        with stream_lock: current_ffmpeg_process = None
-        return None
+                if on_air and on_air.start_failed():
+                    self.abandon_progressive_start(on_air)
+                    retired_pipelines.append(on_air)
+                    on_air = None
 
-def stream_manager():
-    global currently_playing_url, default_video_path, current_ffmpeg_process
+                if on_air:
+                    on_air.poll_segments()
+                    if on_air.is_stalled():
+                        on_air.mark_stalled()
+                    if on_air.loop:
+                        # The queued item may already have been popped into the standby.
+                        # A standby that died goes on air anyway so its restart takes over.
+                        if gapless:
+                            preempt = standby is not None and not standby.loop and self.is_due(standby) and (standby.is_ready() or standby.needs_restart())
+                        else:
+                            preempt = queue_waiting or (standby is not None and self.is_due(standby))
+                        # Once the filler is cut, a looping ffmpeg hands over to it.
+                        if preempt or (self.filler and on_air.process is not None):
+                            on_air.stop(discard=True, wait=False)
+                    elif standby and standby.schedule_entry and not on_air.cancelled and self.is_due(standby) and (standby.is_ready() or standby.needs_restart()):
+                        with self.lock:
+                            self.requeue_interrupted(on_air)
+                        on_air.stop(discard=True, wait=False)
 
-    modified_default_url = ensure_dropbox_raw_param(DEFAULT_VIDEO_URL)
-    temp_default_path = download_video(modified_default_url, DEFAULT_VIDEO_FILENAME)
-    if temp_default_path:
-         default_video_path = temp_default_path
-    # else: print removed
+                    if on_air.is_finished():
+                        if on_air.needs_restart():
+                            self.schedule_restart(on_air)
+                        elif not on_air.loop and not on_air.cancelled:
+                            with self.lock:
+                                self.played.add(on_air.url)
+                        retired_pipelines.append(on_air)
+                        on_air = None
 
-    predownload_attempted_for_url = None
+                if on_air is None and self.pending_restart and time.time() >= self.pending_restart[1]:
+                    failed, _, attempt = self.pending_restart
+                    self.pending_restart = None
+                    on_air = self.restart_pipeline(failed, attempt)
+                    if on_air:
+                        self.begin_transition()
 
-    while not stop_event.is_set():
-        next_video_path = None
-        play_url = None
-        loop_default = False
-        stop_default_and_process_queue = False
+                if on_air is None and not self.pending_restart:
+                    if standby and self.is_due(standby):
+                        on_air, standby = standby, None
+                    else:
+                        on_air = self.launch_next_pipeline(blocking=True)
+                    if on_air:
+                        self.begin_transition()
 
-        try:
-            with stream_lock:
-                ffmpeg_is_running = current_ffmpeg_process and current_ffmpeg_process.poll() is None
-                current_url_snapshot = currently_playing_url
-
-                modified_default_url_snapshot = ensure_dropbox_raw_param(DEFAULT_VIDEO_URL)
-                if ffmpeg_is_running:
-                    if current_url_snapshot != modified_default_url_snapshot and video_queue:
-                        next_url_in_queue_raw = video_queue[0]
-                        next_url_in_queue_modified = ensure_dropbox_raw_param(next_url_in_queue_raw)
-
-                        if next_url_in_queue_modified != predownload_attempted_for_url:
-                            next_filename = get_safe_filename(next_url_in_queue_modified)
-                            downloaded_path = download_video(next_url_in_queue_modified, next_filename)
-                            # if downloaded_path: print removed
-                            # else: print removed
-                            predownload_attempted_for_url = next_url_in_queue_modified
-
-                    elif current_url_snapshot == modified_default_url_snapshot and video_queue:
-                        stop_default_and_process_queue = True
-                        predownload_attempted_for_url = None
+                wait_seconds = IDLE_WAIT_SECONDS
+                if on_air:
+                    self.hls_output.publish_from(on_air)
 
+                    next_due = self.hls_output.next_due(on_air)
+                    if next_due is not None:
+                        wait_seconds = max(0.0, next_due - PUBLISH_SLACK_SECONDS - time.time())
                     else:
-                        if current_url_snapshot != modified_default_url_snapshot and not video_queue:
-                            predownload_attempted_for_url = None
-                        pass
+                        wait_seconds = SEGMENT_POLL_SECONDS
 
-                else:
-                    predownload_attempted_for_url = None
-                    if current_ffmpeg_process and current_ffmpeg_process.poll() is not None:
-                        modified_default_url_snapshot = ensure_dropbox_raw_param(DEFAULT_VIDEO_URL)
-                        if current_url_snapshot and current_url_snapshot != modified_default_url_snapshot:
-                             played_today.add(current_url_snapshot)
-                        current_ffmpeg_process = None
-                        currently_playing_url = None
-
-                    if video_queue:
-                        raw_url_from_queue = video_queue.popleft()
-                        play_url = ensure_dropbox_raw_param(raw_url_from_queue)
-                        filename = get_safe_filename(play_url)
-                        next_video_path = download_video(play_url, filename)
-                        if not next_video_path:
-                            play_url = None
-                            currently_playing_url = None
+                    if gapless and standby is None:
+                        remaining = None if on_air.loop else on_air.remaining()
+                        if on_air.loop:
+                            should_prespawn = queue_waiting
                         else:
-                             loop_default = False
-                             currently_playing_url = play_url
+                            should_prespawn = remaining is not None and remaining <= PRESPAWN_LEAD_SECONDS
+                        if should_prespawn:
+                            # If this returns None the download-complete callback wakes us.
+                            standby = self.launch_next_pipeline(blocking=False)
+                        elif remaining is not None:
+                            wait_seconds = min(wait_seconds, remaining - PRESPAWN_LEAD_SECONDS)
 
-                    elif default_video_path:
-                        modified_default_url_snapshot = ensure_dropbox_raw_param(DEFAULT_VIDEO_URL)
-                        # if current_url_snapshot != modified_default_url_snapshot: print removed
-                        next_video_path = default_video_path
-                        play_url = modified_default_url_snapshot
-                        loop_default = True
-                        currently_playing_url = play_url
+                if standby and not standby.is_ready():
+                    wait_seconds = min(wait_seconds, SEGMENT_POLL_SECONDS)
+                if standby and standby.schedule_entry and not self.is_due(standby):
+                    wait_seconds = min(wait_seconds, max(SEGMENT_POLL_SECONDS, standby.schedule_entry['start_at'] - STAGING_UNIT_SECONDS / 2 - time.time()))
+                elif scheduled and scheduled['start_at'] - prespawn_lead > time.time():
+                    wait_seconds = min(wait_seconds, scheduled['start_at'] - prespawn_lead - time.time())
+                if self.pending_restart:
+                    wait_seconds = min(wait_seconds, max(0.0, self.pending_restart[1] - time.time()))
 
-                    else:
-                        # if current_url_snapshot: print removed
-                        currently_playing_url = None
-                        pass
+                with self.lock:
+                    self.on_air = on_air
+                    self.standby = standby
+                    self.journal.set_now_playing([p.url for p in (on_air, standby) if p and not p.loop and not p.cancelled])
+                    self.resume_offsets = {url: offset for url, offset in self.resume_offsets.items() if url in self.queue}
+                    resume = {url: round(offset, 3) for url, offset in self.resume_offsets.items()}
+                    for pipeline in (standby, on_air):
+                        if pipeline and not pipeline.loop and not pipeline.cancelled and pipeline.playback_position() > 0:
+                            resume[pipeline.url] = round(pipeline.playback_position(), 3)
+                    self.journal.set_resume(resume)
 
-            if stop_default_and_process_queue:
-                stop_ffmpeg_stream()
-                time.sleep(0.5)
-                continue
+                if (on_air and on_air.id, standby and standby.id) != announced:
+                    announced = (on_air and on_air.id, standby and standby.id)
+                    event_bus.publish('now_playing', {'channel': self.name, 'now_playing': pipeline_summary(on_air), 'standby': pipeline_summary(standby)})
 
-            if next_video_path and play_url:
-                started_process = start_ffmpeg_stream(next_video_path, loop=loop_default)
-                if not started_process:
-                     with stream_lock:
-                         if currently_playing_url == play_url:
-                             currently_playing_url = None
-
-            if ffmpeg_is_running:
-                 time.sleep(1)
-            elif not next_video_path:
-                 time.sleep(3)
-            else:
-                 time.sleep(0.5)
+                referenced = self.hls_output.referenced_pipelines()
+                for pipeline in list(retired_pipelines):
+                    if pipeline.id not in referenced:
+                        pipeline.remove_output()
+                        retired_pipelines.remove(pipeline)
 
-        except Exception as e:
-             # traceback.print_exc() removed
-             try:
-                 stop_ffmpeg_stream()
-             except Exception as stop_err:
-                  # print removed
-                  pass
-             with stream_lock:
-                 currently_playing_url = None
-                 predownload_attempted_for_url = None
-             time.sleep(5)
+                self.scheduler_event.wait(wait_seconds)
+                self.scheduler_event.clear()
+
+            except Exception as e:
+                 # traceback.print_exc() removed
+                 try:
+                     self.stop_stream()
+                 except Exception as stop_err:
+                      # print removed
+                      pass
+                 with self.lock:
+                     for pipeline in (self.on_air, self.standby):
+                         if pipeline:
+                             retired_pipelines.append(pipeline)
+                     self.on_air = None
+                     self.standby = None
+                 self.closed.wait(5)
+
+        self.stop_stream()
+
+
+def protected_video_paths():
+    paths = []
+    for channel in list(channels.values()):
+        paths.extend(channel.protected_video_paths())
+    return paths
+
+
+def save_channels():
+    extra = [{'name': c.name, 'default_url': c.default_url, 'push_targets': [t['url'] for t in c.push_targets]}
+             for c in channels.values() if not c.is_main]
+    try:
+        write_file_atomic(CHANNELS_FILE, json.dumps(extra))
+    except OSError as e:
+        pass
+
+
+def load_channels():
+    channels[MAIN_CHANNEL] = Channel(MAIN_CHANNEL, DEFAULT_VIDEO_URL, PUSH_TARGETS)
+    try:
+        with open(CHANNELS_FILE, 'r') as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        saved = []
+    for entry in saved:
+        try:
+            if CHANNEL_NAME_PATTERN.match(entry['name']) and entry['name'] not in channels:
+                channels[entry['name']] = Channel(entry['name'], entry['default_url'], entry.get('push_targets') or ())
+        except (KeyError, TypeError):
+            pass
+
+
+def start_channels():
+    for channel in list(channels.values()):
+        channel.start()
 
-    stop_ffmpeg_stream()
+
+def create_channel(name, default_url, push_targets=()):
+    with channels_lock:
+        if name in channels:
+            return None, 'Channel already exists.'
+        if len(channels) >= MAX_CHANNELS:
+            return None, f'At most {MAX_CHANNELS} channels.'
+        channel = Channel(name, default_url, push_targets)
+        channels[name] = channel
+        save_channels()
+    channel.start()
+    return channel, None
+
+
+def remove_channel(name):
+    with channels_lock:
+        channel = channels.pop(name, None)
+        if channel:
+            save_channels()
+    if not channel:
+        return False
+    channel.close()
+    shutil.rmtree(channel.output_dir, ignore_errors=True)
+    for suffix in ('', '-wal', '-shm'):
+        try:
+            os.remove(channel.journal_path + suffix)
+        except OSError:
+            pass
+    return True
+
+
+load_channels()
 
 
 @app.route('/')
@@ -359,17 +3243,20 @@ def index():
 
 @app.route('/admin')
 def admin_panel():
-    with stream_lock:
-        queue_snapshot = list(video_queue)
-        played_snapshot = list(played_today)
-        current_url_snapshot = currently_playing_url
-        is_ffmpeg_running = current_ffmpeg_process and current_ffmpeg_process.poll() is None
+    channel = channels[MAIN_CHANNEL]
+    with channel.lock:
+        queue_snapshot = list(channel.queue)
+        played_snapshot = list(channel.played)
+        current_url_snapshot = channel.currently_playing_url
+        is_ffmpeg_running = channel.on_air is not None and channel.on_air.is_running()
         status_detail = ""
-        if is_ffmpeg_running and video_queue:
-            next_in_queue_raw = video_queue[0]
+        if is_ffmpeg_running and channel.standby and not channel.standby.loop:
+            status_detail = f" | এরপর (প্রস্তুত): {channel.standby.url[:50]}..."
+        elif is_ffmpeg_running and channel.queue:
+            next_in_queue_raw = channel.queue[0]
             status_detail = f" | এরপর কিউতে: {next_in_queue_raw[:50]}..."
 
-    modified_default_url = ensure_dropbox_raw_param(DEFAULT_VIDEO_URL)
+    modified_default_url = channel.default_url
     if is_ffmpeg_running:
         mode = "[ভিডিও কপি]" if current_url_snapshot != modified_default_url else "(লুপ)"
         if current_url_snapshot == modified_default_url:
@@ -380,25 +3267,30 @@ def admin_panel():
             current_status = "একটি ভিডিও চলছে (URL অজানা)"
     else:
         current_status = "⭕ কোনো ভিডিও চলছে না"
-        if video_queue:
-             current_status += f" | প্লে করার অপেক্ষায়: {video_queue[0][:50]}..."
+        if channel.queue:
+             current_status += f" | প্লে করার অপেক্ষায়: {channel.queue[0][:50]}..."
+
+    downloads = {job['url']: job for job in download_manager.snapshot()}
 
     return render_template('admin.html',
                            queue=queue_snapshot,
                            current_status=current_status,
-                           played=played_snapshot)
+                           played=played_snapshot,
+                           downloads=downloads)
 
 @app.route('/admin/add', methods=['POST'])
 def add_video_form():
+    channel = channels[MAIN_CHANNEL]
     url_from_form = request.form.get('video_url', '').strip()
     if url_from_form:
         if url_from_form.startswith('http://') or url_from_form.startswith('https://'):
-            url_to_add = ensure_dropbox_raw_param(url_from_form)
-            with stream_lock:
-                if url_to_add in video_queue:
+            url_to_add = canonical_url(url_from_form)
+            with channel.lock:
+                if is_upcoming(channel, url_to_add):
                      flash(f'"{url_to_add[:50]}..." এই URL টি ইতিমধ্যে কিউতে আছে (সম্ভবত raw=1 সহ)।', 'warning')
                 else:
-                    video_queue.append(url_to_add)
+                    channel.queue.append(url_to_add)
+                    channel.notify()
                     flash(f'"{url_to_add[:50]}..." সফলভাবে কিউতে যোগ করা হয়েছে।', 'success')
             return redirect(url_for('admin_panel'))
         else:
@@ -409,9 +3301,9 @@ def add_video_form():
 
 @app.route('/admin/clear_queue', methods=['POST'])
 def clear_queue_form():
-    with stream_lock:
-        if video_queue:
-            video_queue.clear()
+    channel = channels[MAIN_CHANNEL]
+    with channel.lock:
+        if clear_upcoming(channel):
             flash('ভিডিও কিউ সফলভাবে খালি করা হয়েছে।', 'success')
         else:
              flash('ভিডিও কিউ আগে থেকেই খালি ছিল।', 'info')
@@ -419,9 +3311,10 @@ def clear_queue_form():
 
 @app.route('/admin/clear_played', methods=['POST'])
 def clear_played_form():
-    with stream_lock:
-        if played_today:
-            played_today.clear()
+    channel = channels[MAIN_CHANNEL]
+    with channel.lock:
+        if channel.played:
+            channel.played.clear()
             flash("'আজকে চালানো হয়েছে' তালিকা খালি করা হয়েছে।", 'success')
         else:
              flash("'আজকে চালানো হয়েছে' তালিকা আগে থেকেই খালি ছিল।", 'info')
@@ -429,7 +3322,9 @@ def clear_played_form():
 
 
 @app.route('/add', methods=['GET'])
-def add_video_api():
+@app.route('/channels/<channel_name>/add', methods=['GET'])
+def add_video_api(channel_name=MAIN_CHANNEL):
+    channel = channel_or_404(channel_name)
     url_from_request = request.args.get('link', '').strip()
     if not url_from_request:
         return jsonify({'status': 'error', 'message': 'Missing "link" parameter.'}), 400
@@ -437,27 +3332,29 @@ def add_video_api():
     if not (url_from_request.startswith('http://') or url_from_request.startswith('https://')):
         return jsonify({'status': 'error', 'message': 'Invalid URL format. Must start with http:// or https://', 'url': url_from_request}), 400
 
-    url_to_add = ensure_dropbox_raw_param(url_from_request)
+    url_to_add = canonical_url(url_from_request)
 
-    with stream_lock:
-        if url_to_add in video_queue:
+    with channel.lock:
+        if is_upcoming(channel, url_to_add):
             return jsonify({'status': 'warning', 'message': 'Video already in queue.', 'url': url_to_add, 'original_url': url_from_request}), 200
         else:
-            video_queue.append(url_to_add)
+            channel.queue.append(url_to_add)
+            channel.notify()
             return jsonify({'status': 'success', 'message': 'Video added to queue.', 'url': url_to_add, 'original_url': url_from_request}), 200
 
 @app.route('/delete', methods=['GET'])
-def delete_video_api():
+@app.route('/channels/<channel_name>/delete', methods=['GET'])
+def delete_video_api(channel_name=MAIN_CHANNEL):
+    channel = channel_or_404(channel_name)
     link_param = request.args.get('link', '').strip()
 
     if not link_param:
         return jsonify({'status': 'error', 'message': 'Missing "link" parameter.'}), 400
 
-    with stream_lock:
+    with channel.lock:
         if link_param.lower() == 'all':
-            if video_queue:
-                queue_len = len(video_queue)
-                video_queue.clear()
+            queue_len = clear_upcoming(channel)
+            if queue_len:
                 return jsonify({'status': 'success', 'message': f'Queue cleared. {queue_len} items removed.'}), 200
             else:
                 return jsonify({'status': 'info', 'message': 'Queue was already empty.'}), 200
@@ -467,24 +3364,720 @@ def delete_video_api():
             if not (url_from_request.startswith('http://') or url_from_request.startswith('https://')):
                  return jsonify({'status': 'error', 'message': 'Invalid URL format for deletion.', 'url': url_from_request}), 400
 
-            url_to_delete = ensure_dropbox_raw_param(url_from_request)
+            url_to_delete = canonical_url(url_from_request)
 
-            current_playing_modified = ensure_dropbox_raw_param(currently_playing_url) if currently_playing_url else None
-            default_url_modified = ensure_dropbox_raw_param(DEFAULT_VIDEO_URL)
+            current_playing_modified = channel.currently_playing_url
+            default_url_modified = channel.default_url
 
             if url_to_delete == current_playing_modified and url_to_delete != default_url_modified:
                  return jsonify({'status': 'error', 'message': 'Cannot delete the currently playing video.', 'url': url_to_delete, 'original_url': url_from_request}), 403
 
+            if channel.standby and not channel.standby.loop and not channel.standby.schedule_entry and channel.standby.url == url_to_delete:
+                channel.standby.cancelled = True
+                channel.notify()
+                return jsonify({'status': 'success', 'message': 'Video removed from queue.', 'url': url_to_delete, 'original_url': url_from_request}), 200
+
             try:
-                video_queue.remove(url_to_delete)
+                channel.queue.remove(url_to_delete)
+                channel.notify()
                 return jsonify({'status': 'success', 'message': 'Video removed from queue.', 'url': url_to_delete, 'original_url': url_from_request}), 200
             except ValueError:
                 return jsonify({'status': 'error', 'message': 'Video not found in queue.', 'url': url_to_delete, 'original_url': url_from_request}), 404
 
 
+def channel_or_404(name):
+    channel = channels.get(name)
+    if channel is None:
+        abort(404)
+    return channel
+
+
+def channel_summary(channel):
+    with channel.lock:
+        return {
+            'name': channel.name,
+            'default_url': channel.default_url,
+            'stream_url': url_for('stream', filename=f'{channel.name}/{HLS_OUTPUT_NAME}' if not channel.is_main else HLS_OUTPUT_NAME),
+            'now_playing': channel.currently_playing_url,
+            'queue_length': len(channel.queue),
+            'push_targets': [target['name'] for target in channel.push_targets],
+        }
+
+
+@app.route('/channels', methods=['GET'])
+def channels_api():
+    return jsonify({'status': 'success', 'channels': [channel_summary(c) for c in list(channels.values())]}), 200
+
+
+@app.route('/channels', methods=['POST'])
+def create_channel_api():
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        return jsonify({'status': 'error', 'message': 'Expected a JSON object with a "name".'}), 400
+    name = str(payload.get('name', '')).strip().lower()
+    if not CHANNEL_NAME_PATTERN.match(name) or name in (MAIN_CHANNEL, LIVE_DIR_NAME):
+        return jsonify({'status': 'error', 'message': 'Invalid channel name. Use up to 32 of a-z, 0-9, "-" and "_".'}), 400
+    default_url = payload.get('default_url') or DEFAULT_VIDEO_URL
+    if not queue_url_from_request(default_url):
+        return jsonify({'status': 'error', 'message': 'Invalid "default_url". Must start with http:// or https://'}), 400
+    push_targets = payload.get('push_targets') or []
+    if not isinstance(push_targets, list) or not all(push_target(url) for url in push_targets):
+        return jsonify({'status': 'error', 'message': f'Invalid "push_targets". Expected a list of {", ".join(sorted(PUSH_FORMATS))} URLs.'}), 400
+    channel, error = create_channel(name, default_url, push_targets)
+    if channel is None:
+        return jsonify({'status': 'error', 'message': error, 'name': name}), 409
+    return jsonify({'status': 'success', 'message': 'Channel created.', 'channel': channel_summary(channel)}), 201
+
+
+@app.route('/channels/<channel_name>', methods=['DELETE'])
+def remove_channel_api(channel_name):
+    if channel_name == MAIN_CHANNEL:
+        return jsonify({'status': 'error', 'message': 'The main channel cannot be removed.'}), 403
+    if not remove_channel(channel_name):
+        return jsonify({'status': 'error', 'message': 'Channel not found.', 'name': channel_name}), 404
+    return jsonify({'status': 'success', 'message': 'Channel removed.', 'name': channel_name}), 200
+
+
+def queue_url_from_request(value):
+    if not isinstance(value, str):
+        return None
+    value = value.strip()
+    if not (value.startswith('http://') or value.startswith('https://')):
+        return None
+    return canonical_url(value)
+
+
+def queue_item_result(status, message, url, original_url):
+    return {'status': status, 'message': message, 'url': url, 'original_url': original_url}
+
+
+def batch_items(key):
+    payload = request.get_json(silent=True)
+    items = payload.get(key) if isinstance(payload, dict) else None
+    if not isinstance(items, list):
+        return None, (jsonify({'status': 'error', 'message': f'Expected a JSON object with a "{key}" list.'}), 400)
+    if len(items) > QUEUE_BATCH_LIMIT:
+        return None, (jsonify({'status': 'error', 'message': f'At most {QUEUE_BATCH_LIMIT} items per batch.'}), 413)
+    return items, None
+
+
+def upcoming_standby(channel):
+    # Caller holds channel.lock. A pre-spawned item has left the queue but not
+    # aired yet, so it still counts as the head of what is upcoming.
+    standby = channel.standby
+    if not standby or standby.loop or standby.cancelled or standby.schedule_entry:
+        return None
+    return standby
+
+
+def is_upcoming(channel, url):
+    # Caller holds channel.lock.
+    standby = upcoming_standby(channel)
+    return url in channel.queue or (standby is not None and standby.url == url)
+
+
+def upcoming_queue(channel):
+    # Caller holds channel.lock.
+    standby = upcoming_standby(channel)
+    urls = list(channel.queue)
+    if standby:
+        urls.insert(0, standby.url)
+    return standby, urls
+
+
+def commit_upcoming(channel, standby, urls):
+    # Caller holds channel.lock. A standby that is no longer first is dropped
+    # and, if it is still wanted, plays from its new place in the queue.
+    if standby:
+        if urls and urls[0] == standby.url:
+            urls = urls[1:]
+        else:
+            standby.cancelled = True
+    if urls != list(channel.queue):
+        channel.queue.reorder(urls)
+    channel.notify()
+
+
+def clear_upcoming(channel):
+    # Caller holds channel.lock. Returns how many upcoming items were dropped,
+    # a pre-spawned queue head included.
+    standby, urls = upcoming_queue(channel)
+    if standby:
+        standby.cancelled = True
+    if channel.queue:
+        channel.queue.clear()
+    channel.notify()
+    return len(urls)
+
+
+def batch_response(channel, results):
+    return jsonify({'status': 'success', 'results': results, 'queue_length': len(channel.queue)}), 200
+
+
+def parse_position(value, length):
+    if value is None:
+        return length
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise ValueError(value)
+    return max(0, min(value, length))
+
+
+@app.route('/queue/add', methods=['POST'])
+@app.route('/channels/<channel_name>/queue/add', methods=['POST'])
+def queue_add_batch_api(channel_name=MAIN_CHANNEL):
+    channel = channel_or_404(channel_name)
+    items, error = batch_items('items')
+    if error:
+        return error
+
+    results = []
+    with channel.lock:
+        positioned = any(isinstance(item, dict) and item.get('position') is not None for item in items)
+        standby, urls = upcoming_queue(channel) if positioned else (None, None)
+        queued = set(urls) if positioned else None
+        inserts = {}
+        for item in items:
+            original_url = item.get('link') if isinstance(item, dict) else item
+            url_to_add = queue_url_from_request(original_url)
+            if url_to_add is None:
+                results.append(queue_item_result('error', 'Invalid URL format. Must start with http:// or https://', None, original_url))
+                continue
+            if is_upcoming(channel, url_to_add) or (queued is not None and url_to_add in queued):
+                results.append(queue_item_result('warning', 'Video already in queue.', url_to_add, original_url))
+                continue
+            if urls is None:
+                channel.queue.append(url_to_add)
+            else:
+                try:
+                    position = parse_position(item.get('position') if isinstance(item, dict) else None, len(urls))
+                except ValueError:
+                    results.append(queue_item_result('error', 'Invalid "position"; expected an integer.', url_to_add, original_url))
+                    continue
+                queued.add(url_to_add)
+                inserts.setdefault(position, []).append(url_to_add)
+            results.append(queue_item_result('success', 'Video added to queue.', url_to_add, original_url))
+        if urls is not None:
+            # Positions refer to the queue as it stood before the batch; items
+            # sharing a position keep their batch order.
+            merged = []
+            for index, url in enumerate(urls):
+                merged.extend(inserts.get(index, ()))
+                merged.append(url)
+            merged.extend(inserts.get(len(urls), ()))
+            commit_upcoming(channel, standby, merged)
+        else:
+            channel.notify()
+        return batch_response(channel, results)
+
+
+@app.route('/queue/next', methods=['POST'])
+@app.route('/channels/<channel_name>/queue/next', methods=['POST'])
+def queue_next_batch_api(channel_name=MAIN_CHANNEL):
+    channel = channel_or_404(channel_name)
+    items, error = batch_items('links')
+    if error:
+        return error
+
+    results = []
+    with channel.lock:
+        standby, urls = upcoming_queue(channel)
+        queued = set(urls)
+        next_urls = []
+        next_set = set()
+        for original_url in items:
+            url_to_add = queue_url_from_request(original_url)
+            if url_to_add is None:
+                results.append(queue_item_result('error', 'Invalid URL format. Must start with http:// or https://', None, original_url))
+                continue
+            if url_to_add in next_set:
+                results.append(queue_item_result('warning', 'Video already in this batch.', url_to_add, original_url))
+                continue
+            if url_to_add in queued:
+                results.append(queue_item_result('success', 'Video moved to play next.', url_to_add, original_url))
+            else:
+                results.append(queue_item_result('success', 'Video added to play next.', url_to_add, original_url))
+            next_urls.append(url_to_add)
+            next_set.add(url_to_add)
+        commit_upcoming(channel, standby, next_urls + [url for url in urls if url not in next_set])
+        return batch_response(channel, results)
+
+
+@app.route('/queue/move', methods=['POST'])
+@app.route('/channels/<channel_name>/queue/move', methods=['POST'])
+def queue_move_batch_api(channel_name=MAIN_CHANNEL):
+    channel = channel_or_404(channel_name)
+    items, error = batch_items('moves')
+    if error:
+        return error
+
+    results = []
+    with channel.lock:
+        standby, urls = upcoming_queue(channel)
+        queued = set(urls)
+        targets = OrderedDict()
+        for item in items:
+            original_url = item.get('link') if isinstance(item, dict) else None
+            url_to_move = queue_url_from_request(original_url)
+            if url_to_move is None:
+                results.append(queue_item_result('error', 'Invalid URL format. Must start with http:// or https://', None, original_url))
+                continue
+            if url_to_move not in queued:
+                results.append(queue_item_result('error', 'Video not found in queue.', url_to_move, original_url))
+                continue
+            position = item.get('position')
+            if isinstance(position, bool) or not isinstance(position, int):
+                results.append(queue_item_result('error', 'Invalid "position"; expected an integer.', url_to_move, original_url))
+                continue
+            targets.pop(url_to_move, None)
+            targets[url_to_move] = position
+            results.append(queue_item_result('success', 'Video moved.', url_to_move, original_url))
+        # Each moved item lands at its requested index of the final order (the
+        # last move of an item wins); the others keep their relative order.
+        placed = deque(sorted(targets.items(), key=lambda target: target[1]))
+        rest = [url for url in urls if url not in targets]
+        merged = []
+        next_rest = 0
+        while placed or next_rest < len(rest):
+            if placed and (placed[0][1] <= len(merged) or next_rest >= len(rest)):
+                merged.append(placed.popleft()[0])
+            else:
+                merged.append(rest[next_rest])
+                next_rest += 1
+        commit_upcoming(channel, standby, merged)
+        return batch_response(channel, results)
+
+
+@app.route('/queue/delete', methods=['POST'])
+@app.route('/channels/<channel_name>/queue/delete', methods=['POST'])
+def queue_delete_batch_api(channel_name=MAIN_CHANNEL):
+    channel = channel_or_404(channel_name)
+    items, error = batch_items('links')
+    if error:
+        return error
+
+    results = []
+    with channel.lock:
+        standby, urls = upcoming_queue(channel)
+        remaining = OrderedDict.fromkeys(urls)
+        current_playing_modified = channel.currently_playing_url
+        default_url_modified = channel.default_url
+        for original_url in items:
+            url_to_delete = queue_url_from_request(original_url)
+            if url_to_delete is None:
+                results.append(queue_item_result('error', 'Invalid URL format for deletion.', None, original_url))
+            elif url_to_delete == current_playing_modified and url_to_delete != default_url_modified:
+                results.append(queue_item_result('error', 'Cannot delete the currently playing video.', url_to_delete, original_url))
+            elif url_to_delete in remaining:
+                del remaining[url_to_delete]
+                results.append(queue_item_result('success', 'Video removed from queue.', url_to_delete, original_url))
+            else:
+                results.append(queue_item_result('error', 'Video not found in queue.', url_to_delete, original_url))
+        commit_upcoming(channel, standby, list(remaining))
+        return batch_response(channel, results)
+
+
+def parse_start_at(value):
+    # Epoch seconds or ISO 8601; a time without an offset is taken as UTC.
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        start_at = float(value)
+    elif isinstance(value, str):
+        try:
+            start_at = float(value)
+        except ValueError:
+            try:
+                moment = datetime.fromisoformat(value.strip().replace('Z', '+00:00'))
+            except ValueError:
+                return None
+            if moment.tzinfo is None:
+                moment = moment.replace(tzinfo=timezone.utc)
+            start_at = moment.timestamp()
+    else:
+        return None
+    return start_at if valid_start_at(start_at) else None
+
+
+def schedule_summary(channel):
+    # Caller holds channel.lock. A scheduled item already pre-spawned has
+    # left the schedule but not aired yet.
+    entries = [dict(entry, state='scheduled') for entry in channel.schedule]
+    standby = channel.standby
+    if standby and standby.schedule_entry and not standby.cancelled:
+        entries.insert(0, dict(standby.schedule_entry, state='standby'))
+    for entry in entries:
+        entry['start_time'] = format_program_date_time(entry['start_at'])
+    return entries
+
+
+@app.route('/schedule', methods=['GET'])
+@app.route('/channels/<channel_name>/schedule', methods=['GET'])
+def schedule_api(channel_name=MAIN_CHANNEL):
+    channel = channel_or_404(channel_name)
+    with channel.lock:
+        return jsonify({'status': 'success', 'schedule': schedule_summary(channel)}), 200
+
+
+@app.route('/schedule', methods=['POST'])
+@app.route('/channels/<channel_name>/schedule', methods=['POST'])
+def schedule_add_api(channel_name=MAIN_CHANNEL):
+    channel = channel_or_404(channel_name)
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        return jsonify({'status': 'error', 'message': 'Expected a JSON object with "link" and "start_at".'}), 400
+    original_url = payload.get('link')
+    url_to_add = queue_url_from_request(original_url)
+    if url_to_add is None:
+        return jsonify({'status': 'error', 'message': 'Invalid URL format. Must start with http:// or https://', 'original_url': original_url}), 400
+    start_at = parse_start_at(payload.get('start_at'))
+    if start_at is None:
+        return jsonify({'status': 'error', 'message': 'Invalid "start_at"; expected epoch seconds or an ISO 8601 time.'}), 400
+    if start_at < time.time() - SCHEDULE_MAX_PAST_SECONDS:
+        return jsonify({'status': 'error', 'message': f'"start_at" is more than {int(SCHEDULE_MAX_PAST_SECONDS)} seconds in the past.'}), 400
+    entry = channel.add_scheduled(url_to_add, start_at)
+    return jsonify({'status': 'success', 'message': 'Video scheduled.', 'entry': dict(entry, start_time=format_program_date_time(start_at)),
+                    'original_url': original_url}), 201
+
+
+@app.route('/schedule/<entry_id>', methods=['DELETE'])
+@app.route('/channels/<channel_name>/schedule/<entry_id>', methods=['DELETE'])
+def schedule_delete_api(entry_id, channel_name=MAIN_CHANNEL):
+    channel = channel_or_404(channel_name)
+    with channel.lock:
+        entry = channel.remove_scheduled(entry_id)
+        standby = channel.standby
+        if entry is None and standby and standby.schedule_entry and standby.schedule_entry['id'] == entry_id and not standby.cancelled:
+            standby.cancelled = True
+            entry = standby.schedule_entry
+        if entry is None:
+            return jsonify({'status': 'error', 'message': 'Schedule entry not found.', 'id': entry_id}), 404
+    channel.notify()
+    return jsonify({'status': 'success', 'message': 'Schedule entry removed.', 'entry': entry}), 200
+
+
+def pipeline_summary(pipeline):
+    if not pipeline:
+        return None
+    return {
+        'id': pipeline.id,
+        'url': pipeline.url,
+        'loop': pipeline.loop,
+        'mode': pipeline.start_mode(),
+        'started_at': pipeline.started_at,
+        'duration': pipeline.duration,
+        'remaining': pipeline.remaining(),
+        'first_segment_at': pipeline.first_segment_at,
+        'running': pipeline.is_running(),
+        'start_offset': pipeline.start_offset,
+        'position': pipeline.playback_position(),
+        'backlog': round(pipeline.backlog_seconds(), 3),
+        'scheduled_at': pipeline.schedule_entry['start_at'] if pipeline.schedule_entry else None,
+        'restarts': pipeline.restarts,
+        'progress': dict(pipeline.progress, bitrate_kbps=pipeline.bitrate_kbps()),
+        'stderr': list(pipeline.stderr_tail),
+    }
+
+
+def push_summary(channel):
+    # Caller holds channel.lock. Only the pipeline on air pushes.
+    pipeline = channel.on_air
+    running = pipeline is not None and pipeline.is_running()
+    targets = []
+    for index, target in enumerate(channel.push_targets):
+        failure = pipeline.push_failures.get(index) if running else None
+        if failure:
+            state = 'failed'
+        elif running:
+            state = 'active' if pipeline.progress else 'starting'
+        else:
+            state = 'idle'
+        targets.append({
+            'target': target['name'],
+            'format': target['format'],
+            'state': state,
+            'error': failure['error'] if failure else None,
+            'failed_at': failure['failed_at'] if failure else None,
+            'failures': channel.push_failure_count[index],
+        })
+    return targets
+
+
+def status_snapshot(channel, queue_limit):
+    # Read first: an event published while the snapshot is taken must come
+    # after its id, or a watcher resyncing from it would never see it.
+    last_event_id = event_bus.last_id
+    with channel.lock:
+        on_air = channel.on_air
+        standby = channel.standby
+        queue_length = len(channel.queue)
+        queue_head = list(itertools.islice(channel.queue, queue_limit))
+        played_count = len(channel.played)
+        schedule = schedule_summary(channel)
+        push = push_summary(channel)
+    return {
+        'channel': channel.name,
+        'now_playing': pipeline_summary(on_air),
+        'standby': pipeline_summary(standby),
+        'queue_length': queue_length,
+        'queue': queue_head,
+        'played_count': played_count,
+        'schedule': schedule,
+        'push': push,
+        'downloads': download_manager.snapshot(),
+        'cache': video_cache.stats(),
+        'ingest': ingest_manager.snapshot(),
+        'last_event_id': last_event_id,
+    }
+
+
+def format_sse(event_id, name, data):
+    return f"id: {event_id}\nevent: {name}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.route('/status', methods=['GET'])
+@app.route('/channels/<channel_name>/status', methods=['GET'])
+def status_api(channel_name=MAIN_CHANNEL):
+    channel = channel_or_404(channel_name)
+    try:
+        queue_limit = max(0, int(request.args.get('queue_limit', '100')))
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid "queue_limit" parameter.'}), 400
+    return jsonify(dict(status_snapshot(channel, queue_limit), status='success')), 200
+
+
+@app.route('/events', methods=['GET'])
+@app.route('/channels/<channel_name>/events', methods=['GET'])
+def events_api(channel_name=MAIN_CHANNEL):
+    channel = channel_or_404(channel_name)
+    try:
+        last_id = int(request.headers.get('Last-Event-ID') or request.args.get('last_event_id', ''))
+    except ValueError:
+        last_id = None
+
+    def generate(last_id):
+        # Shared events (downloads) carry no channel and go to every watcher.
+        yield f"retry: {int(SSE_RETRY_SECONDS * 1000)}\n\n"
+        while not stop_event.is_set():
+            events = event_bus.since(last_id, SSE_KEEPALIVE_SECONDS) if last_id is not None else None
+            if events is None:
+                # New watcher, or one that fell behind the log: resync from a full snapshot.
+                snapshot = status_snapshot(channel, SSE_SNAPSHOT_QUEUE_LIMIT)
+                last_id = snapshot['last_event_id']
+                yield format_sse(last_id, 'status', snapshot)
+                continue
+            if not events:
+                yield ": keepalive\n\n"
+                continue
+            for event in events:
+                if event['data'].get('channel', channel.name) == channel.name:
+                    yield format_sse(event['id'], event['event'], dict(event['data'], time=event['time']))
+            last_id = events[-1]['id']
+
+    response = app.response_class(stream_with_context(generate(last_id)), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def stored_response(item):
+    if item['path']:
+        # Goes out through the server's wsgi.file_wrapper, i.e. sendfile() under gunicorn.
+        try:
+            response = send_file(item['path'], mimetype=item['content_type'], etag=item['etag'],
+                                 last_modified=item['last_modified'], max_age=None, conditional=True)
+        except OSError:
+            abort(404)
+    else:
+        response = app.response_class(item['data'], mimetype=item['content_type'])
+        response.set_etag(item['etag'])
+        response.last_modified = item['last_modified']
+        response = response.make_conditional(request)
+    if item['immutable']:
+        response.headers['Cache-Control'] = f'public, max-age={SEGMENT_MAX_AGE}, immutable'
+    else:
+        response.headers['Cache-Control'] = f'public, max-age={PLAYLIST_MAX_AGE}, must-revalidate'
+    return response
+
+
+@app.route('/downloads', methods=['GET'])
+def downloads_api():
+    return jsonify({
+        'status': 'success',
+        'downloads': download_manager.snapshot(),
+        'cache': video_cache.stats(),
+        'ingest': ingest_manager.snapshot(),
+        'startups': list(startup_history),
+    }), 200
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def metric_family(lines, name, kind, help_text, samples):
+    lines.append(f'# HELP {name} {help_text}')
+    lines.append(f'# TYPE {name} {kind}')
+    for suffix, labels, value in samples:
+        label_text = ','.join(f'{key}="{escape_label_value(labels[key])}"' for key in labels)
+        lines.append(f'{name}{suffix}{{{label_text}}} {value}' if label_text else f'{name}{suffix} {value}')
+
+
+def metrics_text():
+    channel_list = list(channels.values())
+    pipelines = []
+    for channel in channel_list:
+        with channel.lock:
+            for role, pipeline in (('on_air', channel.on_air), ('standby', channel.standby)):
+                if pipeline:
+                    pipelines.append(({'channel': channel.name, 'role': role}, pipeline))
+
+    push = []
+    for channel in channel_list:
+        with channel.lock:
+            for index, target in enumerate(push_summary(channel)):
+                push.append(({'channel': channel.name, 'index': str(index), 'target': target['target']}, target))
+
+    def progress_samples(key):
+        return [('', labels, pipeline.progress[key]) for labels, pipeline in pipelines if pipeline.progress.get(key) is not None]
+
+    downloads = [job for job in download_manager.snapshot() if job['state'] == 'downloading']
+    cache = video_cache.stats()
+    ingest = ingest_manager.snapshot()
+
+    lines = []
+    metric_family(lines, 'stream_ffmpeg_up', 'gauge', 'Whether the pipeline ffmpeg process is running.',
+                  [('', labels, int(pipeline.is_running())) for labels, pipeline in pipelines])
+    metric_family(lines, 'stream_ffmpeg_speed', 'gauge', 'Encode speed as a multiple of real time.', progress_samples('speed'))
+    metric_family(lines, 'stream_ffmpeg_fps', 'gauge', 'Frames encoded per second.', progress_samples('fps'))
+    metric_family(lines, 'stream_ffmpeg_bitrate_kbps', 'gauge', 'Output bitrate of the pipeline.',
+                  [('', labels, pipeline.bitrate_kbps()) for labels, pipeline in pipelines if pipeline.bitrate_kbps() is not None])
+    metric_family(lines, 'stream_ffmpeg_out_time_seconds', 'gauge', 'Media time written by the pipeline.', progress_samples('out_time'))
+    metric_family(lines, 'stream_ffmpeg_restarts_total', 'counter', 'Pipelines restarted after a stall or crash.',
+                  [('', {'channel': channel.name}, channel.restart_count) for channel in channel_list])
+    metric_family(lines, 'stream_ffmpeg_stalls_total', 'counter', 'Pipelines that stopped producing segments.',
+                  [('', {'channel': channel.name}, channel.stall_count) for channel in channel_list])
+    metric_family(lines, 'stream_segment_write_latency_seconds', 'histogram', 'How far each segment write fell behind real time.',
+                  [sample for channel in channel_list for sample in channel.segment_latency.samples({'channel': channel.name})])
+    metric_family(lines, 'stream_push_up', 'gauge', 'Whether the push target is receiving the on-air pipeline.',
+                  [('', labels, int(target['state'] == 'active')) for labels, target in push])
+    metric_family(lines, 'stream_push_failures_total', 'counter', 'Push target failures reported by ffmpeg.',
+                  [('', labels, target['failures']) for labels, target in push])
+    metric_family(lines, 'stream_queue_depth', 'gauge', 'Items waiting in the channel queue.',
+                  [('', {'channel': channel.name}, len(channel.queue)) for channel in channel_list])
+    metric_family(lines, 'stream_download_bytes_total', 'counter', 'Bytes fetched by the download manager.',
+                  [('', {}, download_manager.bytes_downloaded)])
+    metric_family(lines, 'stream_downloads_active', 'gauge', 'Downloads in progress.', [('', {}, len(downloads))])
+    metric_family(lines, 'stream_download_bytes_per_second', 'gauge', 'Combined throughput of the downloads in progress.',
+                  [('', {}, sum(job['bytes_per_second'] for job in downloads))])
+    metric_family(lines, 'stream_cache_bytes', 'gauge', 'Bytes held by the video cache.', [('', {}, cache['bytes'])])
+    metric_family(lines, 'stream_cache_budget_bytes', 'gauge', 'Video cache budget.', [('', {}, cache['budget_bytes'])])
+    metric_family(lines, 'stream_ingest_pending', 'gauge', 'Cached videos waiting for normalisation.', [('', {}, ingest['pending'])])
+    return '\n'.join(lines) + '\n'
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_api():
+    return app.response_class(metrics_text(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@app.route('/abr/cost', methods=['GET'])
+def abr_cost_api():
+    global abr_cost_last
+    channel = channels[MAIN_CHANNEL]
+    try:
+        seconds = min(60.0, max(1.0, float(request.args.get('seconds', '10'))))
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid "seconds" parameter.'}), 400
+
+    with channel.lock:
+        pipeline = channel.on_air
+    video_path = pipeline.video_path if pipeline else channel.default_video_path
+    if not video_path:
+        return jsonify({'status': 'error', 'message': 'No video available to measure.'}), 404
+
+    # One measurement at a time; callers arriving meanwhile get its result.
+    key = (video_path, seconds)
+    with abr_cost_lock:
+        if abr_cost_last and abr_cost_last[0] == key and time.time() - abr_cost_last[1] < ABR_COST_CACHE_SECONDS:
+            measured_at, renditions = abr_cost_last[1], abr_cost_last[2]
+        else:
+            has_audio = probe_has_audio(video_path)
+            renditions = [measure_rendition_cost(video_path, name, seconds, has_audio) for name in (ABR_LADDER or list(ABR_RENDITIONS))]
+            measured_at = time.time()
+            abr_cost_last = (key, measured_at, renditions)
+
+    live_process = None
+    live_cores = 0.0
+    with channels_lock:
+        live_channels = list(channels.values())
+    for live_channel in live_channels:
+        with live_channel.lock:
+            running = [p for p in (live_channel.on_air, live_channel.standby) if p and p.process is not None and p.is_running()]
+        for live_pipeline in running:
+            cpu_seconds = process_cpu_seconds(live_pipeline.process.pid)
+            if cpu_seconds is None:
+                continue
+            cores = cpu_seconds / max(time.time() - live_pipeline.started_at, 0.001)
+            live_cores += cores
+            if live_pipeline is pipeline:
+                live_process = {'pid': pipeline.process.pid, 'cpu_seconds': round(cpu_seconds, 3), 'cores': round(cores, 3)}
+    # With a ladder on air its cost is already part of the live load.
+    ladder_cores = 0.0 if ABR_LADDER else sum(r.get('cores_at_realtime') or 0.0 for r in renditions)
+    cpus = os.cpu_count() or 1
+
+    return jsonify({
+        'status': 'success',
+        'mode': 'abr' if ABR_LADDER else 'single',
+        'ladder': ABR_LADDER,
+        'sample_seconds': seconds,
+        'renditions': renditions,
+        'measured_at': measured_at,
+        'live_process': live_process,
+        'cpu': {
+            'cpus': cpus,
+            'live_cores': round(live_cores, 3),
+            'headroom_cores': round(cpus - live_cores - ladder_cores, 3),
+        },
+    }), 200
+
+
+def parse_blocking_reload_args():
+    try:
+        msn = int(request.args['_HLS_msn'])
+        part = int(request.args['_HLS_part']) if '_HLS_part' in request.args else None
+    except (KeyError, ValueError):
+        return None, None
+    return msn, part
+
+
+def channel_for_stream_path(filename):
+    name, _, rest = filename.partition('/')
+    channel = channels.get(name)
+    if channel and not channel.is_main and rest:
+        return channel, rest
+    return channels[MAIN_CHANNEL], filename
+
+
 @app.route('/stream/<path:filename>')
 def stream(filename):
-    stream_abs_path = os.path.abspath(STREAM_OUTPUT_DIR)
+    channel, filename = channel_for_stream_path(filename)
+    if LOW_LATENCY and '_HLS_msn' in request.args:
+        timeline = channel.hls_output.timeline_for(filename)
+        if timeline is not None:
+            msn, part = parse_blocking_reload_args()
+            if msn is None or msn > timeline.next_media_sequence() + 1:
+                abort(400)
+            if not channel.store.wait_until(lambda: timeline.has_media(msn, part), BLOCKING_RELOAD_TIMEOUT):
+                abort(503)
+
+    item = channel.store.get(filename)
+    if item is None and LOW_LATENCY and filename.startswith(f"{LIVE_DIR_NAME}/") and filename.endswith('.m4s'):
+        # Preload hints point at the next part before it exists; hold the request.
+        item = channel.store.wait_for(filename, LL_PART_TARGET * 3)
+    if item is not None:
+        return stored_response(item)
+
+    stream_abs_path = os.path.abspath(channel.output_dir)
     safe_base = os.path.normpath(stream_abs_path)
     file_abs_path = os.path.normpath(os.path.join(safe_base, filename))
 
@@ -507,22 +4100,68 @@ def stream(filename):
         # Error logging removed
         abort(500)
 
+def acquire_supervisor_lock():
+    global supervisor_lock_file
+    if os.name == 'nt':
+        return True
+    import fcntl
+    lock_file = open(SUPERVISOR_LOCK_PATH, 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    supervisor_lock_file = lock_file
+    return True
+
+
+def start_services():
+    # The stream supervisor (channels, downloads, ingest) must run exactly once
+    # per node: a second copy would fight over the same ffmpeg outputs and
+    # queue journals, so only the process holding the lock may start it.
+    global services_started
+    with services_lock:
+        if services_started:
+            return
+        if not acquire_supervisor_lock():
+            raise RuntimeError(f"Stream supervisor already running ({SUPERVISOR_LOCK_PATH} is locked); serve with a single worker process.")
+        services_started = True
+    download_manager.start()
+    ingest_manager.start()
+    start_channels()
+
+
+def begin_shutdown():
+    # Wakes the schedulers, SSE streams and blocking reloads so that in-flight
+    # requests finish instead of holding up a graceful stop.
+    stop_event.set()
+    notify_scheduler()
+    event_bus.wake()
+    for channel in list(channels.values()):
+        channel.store.wake()
+
+
+def stop_services():
+    begin_shutdown()
+    for channel in list(channels.values()):
+        channel.close()
+    ingest_manager.stop()
+
+
 def signal_handler(sig, frame):
     if stop_event.is_set():
         return
-    stop_event.set()
-    stop_ffmpeg_stream()
+    stop_services()
     exit(0)
 
 if __name__ == '__main__':
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
 
-    manager_thread = threading.Thread(target=stream_manager, name="StreamManager", daemon=True)
-    manager_thread.start()
+    start_services()
 
     host = '0.0.0.0'
-    port = 5000
+    port = int(os.environ.get('PORT', '5000'))
 
     try:
         app.run(host=host, port=port, threaded=True, use_reloader=False, debug=False)
@@ -530,11 +4169,4 @@ if __name__ == '__main__':
         # traceback.print_exc() removed
         pass # Suppress Flask run error print
     finally:
-        if not stop_event.is_set():
-            stop_event.set()
-
-        if manager_thread.is_alive():
-            manager_thread.join(timeout=10)
-            # if manager_thread.is_alive(): print removed
-
-        stop_ffmpeg_stream()
+        stop_services()
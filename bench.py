@@ -0,0 +1,644 @@
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Offline benchmark for the streaming hot paths. Media comes from ffmpeg's
+# lavfi sources and is served by a local HTTP server standing in for Dropbox;
+# the app runs as a real server process in a scratch directory.
+#
+#   python bench.py --clients 500 --duration 60 --output results.json
+#   python bench.py --compare before.json after.json
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# name: (seconds, size, video bitrate, sine frequency)
+MEDIA = {
+    'default.mp4': (10, '640x360', '800k', 440),
+    'clip_a.mp4': (10, '640x360', '800k', 550),
+    'clip_b.mp4': (10, '640x360', '800k', 660),
+    'big.mp4': (30, '1280x720', '8M', 330),
+    'slow.mp4': (20, '1280x720', '8M', 770),
+    'long.mp4': (30, '640x360', '800k', 880),
+}
+CHUNK_SIZE = 64 * 1024
+
+
+def percentiles(values):
+    if not values:
+        return {'count': 0}
+    values = sorted(values)
+
+    def pick(fraction):
+        return round(values[min(len(values) - 1, int(fraction * len(values)))], 6)
+
+    return {
+        'count': len(values),
+        'mean': round(sum(values) / len(values), 6),
+        'p50': pick(0.50),
+        'p95': pick(0.95),
+        'p99': pick(0.99),
+        'max': round(values[-1], 6),
+    }
+
+
+def generate_media(media_dir):
+    os.makedirs(media_dir, exist_ok=True)
+    for name, (seconds, size, bitrate, frequency) in MEDIA.items():
+        path = os.path.join(media_dir, name)
+        if os.path.exists(path):
+            continue
+        subprocess.run([
+            'ffmpeg', '-v', 'error', '-y',
+            '-f', 'lavfi', '-i', f'testsrc2=size={size}:rate=25',
+            '-f', 'lavfi', '-i', f'sine=frequency={frequency}:sample_rate=48000',
+            '-t', str(seconds),
+            '-c:v', 'libx264', '-preset', 'ultrafast', '-b:v', bitrate, '-g', '50', '-pix_fmt', 'yuv420p',
+            '-c:a', 'aac', '-b:a', '128k',
+            '-movflags', '+faststart',
+            path,
+        ], check=True)
+
+
+class MediaHandler(BaseHTTPRequestHandler):
+    # /<file> is served at full speed, /slow/<file> at the server's slow_rate.
+    # The first full request for /flaky/<file> is cut off halfway, so the
+    # client has to resume with Range.
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path = urllib.parse.urlparse(self.path).path
+        slow = path.startswith('/slow/')
+        flaky = path.startswith('/flaky/')
+        name = os.path.basename(path)
+        file_path = os.path.join(self.server.media_dir, name)
+        if not name or not os.path.isfile(file_path):
+            self.send_error(404)
+            return
+        size = os.path.getsize(file_path)
+        start = 0
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        end = size - 1
+        if match:
+            start = int(match.group(1))
+            if match.group(2):
+                end = min(end, int(match.group(2)))
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'video/mp4')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        remaining = end - start + 1
+        if flaky and not match and path not in self.server.dropped:
+            self.server.dropped.add(path)
+            remaining //= 2
+            self.close_connection = True
+        with open(file_path, 'rb') as f:
+            f.seek(start)
+            while remaining > 0:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                try:
+                    self.wfile.write(chunk)
+                except OSError:
+                    return
+                remaining -= len(chunk)
+                if slow:
+                    time.sleep(len(chunk) / self.server.slow_rate)
+
+
+def start_media_server(media_dir, slow_rate):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MediaHandler)
+    server.daemon_threads = True
+    server.media_dir = media_dir
+    server.slow_rate = slow_rate
+    server.dropped = set()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_app(work_dir, port, server, env_overrides):
+    env = dict(os.environ)
+    env.update({
+        'PORT': str(port),
+        'DEFAULT_VIDEO_URL': env_overrides.pop('DEFAULT_VIDEO_URL'),
+        # Ingest would turn items into stream copies and compete for CPU;
+        # the suite measures the audio re-encode path unless told otherwise.
+        'INGEST_ENABLED': '0',
+    })
+    env.update(env_overrides)
+    if server == 'gunicorn':
+        command = [sys.executable, '-m', 'gunicorn', '-c', os.path.join(APP_DIR, 'gunicorn.conf.py'),
+                   '--pythonpath', APP_DIR, '-b', f'127.0.0.1:{port}', 'app:app']
+    else:
+        command = [sys.executable, os.path.join(APP_DIR, 'app.py')]
+    log = open(os.path.join(work_dir, 'app.log'), 'wb')
+    return subprocess.Popen(command, cwd=work_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+def http_get(base_url, path, timeout=30):
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(base_url + path, timeout=timeout) as response:
+            body = response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        body = e.read()
+        status = e.code
+    return status, body, time.perf_counter() - started
+
+
+def get_json(base_url, path):
+    status, body, _ = http_get(base_url, path)
+    return json.loads(body) if status == 200 else None
+
+
+def wait_for(predicate, timeout, interval=0.2):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if predicate():
+                return True
+        except (OSError, ValueError):
+            pass
+        time.sleep(interval)
+    return False
+
+
+def parse_playlist(text):
+    target_duration = None
+    segments = []
+    duration = None
+    for line in text.splitlines():
+        if line.startswith('#EXT-X-TARGETDURATION:'):
+            target_duration = float(line.split(':', 1)[1])
+        elif line.startswith('#EXTINF:'):
+            duration = float(line[8:].split(',', 1)[0])
+        elif line and not line.startswith('#'):
+            segments.append((line, duration))
+    return target_duration, segments
+
+
+class PlaylistWatcher:
+    # Polls the public playlist and notes when each segment first appears.
+    # Segment URIs carry the pipeline id, so item transitions show up as a
+    # change of pipeline between consecutive segments.
+    def __init__(self, base_url, interval):
+        self.base_url = base_url
+        self.interval = interval
+        self.seen = {}
+        self.order = []
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                status, body, _ = http_get(self.base_url, '/stream/stream.m3u8', timeout=5)
+            except OSError:
+                status = None
+            if status == 200:
+                now = time.time()
+                for uri, duration in parse_playlist(body.decode())[1]:
+                    if uri not in self.seen:
+                        self.seen[uri] = (now, duration)
+                        self.order.append(uri)
+            self.stop_event.wait(self.interval)
+
+    def results(self):
+        lateness = []
+        transitions = []
+        for previous, current in zip(self.order, self.order[1:]):
+            previous_at, previous_duration = self.seen[previous]
+            current_at, _ = self.seen[current]
+            # How much later than a continuous timeline the next segment showed up.
+            late = current_at - previous_at - previous_duration
+            if previous.split('/')[1] != current.split('/')[1]:
+                transitions.append(round(late, 3))
+            else:
+                lateness.append(late)
+        return {
+            'poll_interval': self.interval,
+            'segments_seen': len(self.order),
+            'transitions': len(transitions),
+            'transition_gaps': transitions,
+            'max_transition_gap': max(transitions) if transitions else None,
+            'steady_state_lateness': percentiles(lateness),
+        }
+
+
+async def read_response(reader):
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    status = int(lines[0].split()[1])
+    headers = {}
+    for line in lines[1:]:
+        if ':' in line:
+            key, value = line.split(':', 1)
+            headers[key.strip().lower()] = value.strip()
+    if 'content-length' in headers:
+        body = await reader.readexactly(int(headers['content-length']))
+    else:
+        body = await reader.read()
+    return status, headers, body
+
+
+async def hls_client(host, port, deadline, stats):
+    # Behaves like a player: reload the playlist once per target duration and
+    # fetch the segments it has not seen, starting three from the live edge.
+    reader = writer = None
+    seen = None
+    await asyncio.sleep(random.random() * 2)
+    while time.monotonic() < deadline:
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(host, port)
+            started = time.perf_counter()
+            writer.write(b'GET /stream/stream.m3u8 HTTP/1.1\r\nHost: bench\r\n\r\n')
+            await writer.drain()
+            status, headers, body = await read_response(reader)
+            stats['playlist'].append(time.perf_counter() - started)
+            if status != 200:
+                stats['errors'] += 1
+                await asyncio.sleep(1)
+                continue
+            target_duration, segments = parse_playlist(body.decode())
+            uris = [uri for uri, _ in segments]
+            if seen is None:
+                seen = set(uris[:-3])
+            for uri in uris:
+                if uri in seen:
+                    continue
+                seen.add(uri)
+                started = time.perf_counter()
+                writer.write(f'GET /stream/{uri} HTTP/1.1\r\nHost: bench\r\n\r\n'.encode())
+                await writer.drain()
+                status, headers, body = await read_response(reader)
+                stats['segment'].append(time.perf_counter() - started)
+                if status == 200:
+                    stats['bytes'] += len(body)
+                else:
+                    stats['errors'] += 1
+            if headers.get('connection', '').lower() == 'close':
+                writer.close()
+                writer = None
+            await asyncio.sleep(target_duration or 2)
+        except (OSError, asyncio.IncompleteReadError, ValueError, IndexError):
+            stats['errors'] += 1
+            if writer is not None:
+                writer.close()
+            writer = None
+            await asyncio.sleep(1)
+    if writer is not None:
+        writer.close()
+
+
+async def run_hls_clients(host, port, clients, duration):
+    stats = {'playlist': [], 'segment': [], 'bytes': 0, 'errors': 0}
+    deadline = time.monotonic() + duration
+    started = time.perf_counter()
+    await asyncio.gather(*(hls_client(host, port, deadline, stats) for _ in range(clients)))
+    elapsed = time.perf_counter() - started
+    requests = len(stats['playlist']) + len(stats['segment'])
+    return {
+        'clients': clients,
+        'seconds': round(elapsed, 3),
+        'requests': requests,
+        'requests_per_second': round(requests / elapsed, 1),
+        'bytes_per_second': int(stats['bytes'] / elapsed),
+        'errors': stats['errors'],
+        'playlist_latency': percentiles(stats['playlist']),
+        'segment_latency': percentiles(stats['segment']),
+    }
+
+
+def process_tree(root_pid):
+    parents = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            parents[int(entry)] = int(fields[1])
+        except (OSError, IndexError, ValueError):
+            continue
+    tree = {root_pid}
+    changed = True
+    while changed:
+        changed = False
+        for pid, parent in parents.items():
+            if parent in tree and pid not in tree:
+                tree.add(pid)
+                changed = True
+    return tree
+
+
+def ffmpeg_cpu_times(root_pid):
+    times = {}
+    for pid in process_tree(root_pid):
+        try:
+            with open(f'/proc/{pid}/cmdline', 'rb') as f:
+                args = f.read().decode(errors='replace').split('\0')
+            with open(f'/proc/{pid}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if not args or os.path.basename(args[0]) != 'ffmpeg':
+            continue
+        if '-c' in args and args[args.index('-c') + 1] == 'copy':
+            mode = 'copy'
+        elif '-c:v' in args and args[args.index('-c:v') + 1] == 'copy':
+            mode = 'audio_transcode'
+        else:
+            mode = 'transcode'
+        times[pid] = (mode, int(fields[11]) + int(fields[12]))
+    return times
+
+
+def measure_cpu(app_pid, seconds):
+    ticks = os.sysconf('SC_CLK_TCK')
+    before = ffmpeg_cpu_times(app_pid)
+    started = time.time()
+    time.sleep(seconds)
+    after = ffmpeg_cpu_times(app_pid)
+    elapsed = time.time() - started
+    streams = []
+    for pid, (mode, total) in after.items():
+        if pid in before:
+            streams.append({'pid': pid, 'mode': mode, 'cores': round((total - before[pid][1]) / ticks / elapsed, 4)})
+    by_mode = {}
+    for stream in streams:
+        by_mode.setdefault(stream['mode'], []).append(stream['cores'])
+    return {
+        'sample_seconds': round(elapsed, 2),
+        'streams': streams,
+        'cores_per_stream': {mode: round(sum(values) / len(values), 4) for mode, values in by_mode.items()},
+    }
+
+
+def measure_download(base_url, url):
+    http_get(base_url, '/add?' + urllib.parse.urlencode({'link': url}))
+
+    def finished_job():
+        for job in get_json(base_url, '/downloads')['downloads']:
+            if job['url'] == url and job['state'] in ('done', 'failed'):
+                return job
+        return None
+
+    wait_for(finished_job, 120)
+    job = finished_job()
+    if not job or job['state'] != 'done':
+        return {'state': job and job['state']}
+    seconds = job['finished_at'] - job['started_at']
+    return {
+        'bytes': job['downloaded'],
+        'seconds': round(seconds, 3),
+        'bytes_per_second': int(job['downloaded'] / seconds) if seconds > 0 else None,
+        'retries': job.get('retries', 0),
+    }
+
+
+def measure_control_latency(base_url, media_url, samples):
+    # /add and /delete round trips while a throttled download keeps
+    # download_video() busy in the background.
+    slow_url = media_url + '/slow/slow.mp4'
+    http_get(base_url, '/add?' + urllib.parse.urlencode({'link': slow_url}))
+
+    def downloading():
+        return any(job['url'] == slow_url and job['state'] == 'downloading' for job in get_json(base_url, '/downloads')['downloads'])
+
+    busy = wait_for(downloading, 30, interval=0.05)
+    add_latency = []
+    delete_latency = []
+    for i in range(samples):
+        link = urllib.parse.urlencode({'link': f'{media_url}/missing/control-{i}.mp4'})
+        add_latency.append(http_get(base_url, '/add?' + link)[2])
+        delete_latency.append(http_get(base_url, '/delete?' + link)[2])
+    return {
+        'download_busy': busy and downloading(),
+        'add': percentiles(add_latency),
+        'delete': percentiles(delete_latency),
+    }
+
+
+def measure_transition_lag(base_url, media_url, items, bound, timeout):
+    # Back-to-back items much longer than the pre-spawn lead. The backlog
+    # between ffmpeg's output and the published playlist starts at about the
+    # lead on every handoff and must not grow from one item to the next.
+    urls = set()
+    for index in range(items):
+        _, body, _ = http_get(base_url, '/add?' + urllib.parse.urlencode({'link': f'{media_url}/long.mp4?item={index}'}))
+        urls.add(json.loads(body)['url'])
+    backlogs = {}
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        status = get_json(base_url, '/status')
+        pipeline = status and status['now_playing']
+        if pipeline and pipeline['url'] in urls:
+            # Keyed by URL: a restarted pipeline is still the same item.
+            backlogs[pipeline['url']] = max(backlogs.get(pipeline['url'], 0.0), pipeline['backlog'])
+        elif status and not status['queue_length'] and not status['standby'] and backlogs:
+            break
+        time.sleep(0.5)
+    peaks = list(backlogs.values())
+    return {
+        'items': items,
+        'items_seen': len(peaks),
+        'bound': bound,
+        'max_backlog_per_item': peaks,
+        'bounded': len(peaks) == items and all(peak <= bound for peak in peaks),
+    }
+
+
+def queue_length(base_url):
+    status = get_json(base_url, '/status')
+    return status['queue_length'] + (1 if status['standby'] and not status['standby']['loop'] else 0)
+
+
+def ffmpeg_version():
+    try:
+        return subprocess.run(['ffmpeg', '-version'], stdout=subprocess.PIPE, text=True).stdout.splitlines()[0]
+    except (OSError, IndexError):
+        return None
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=APP_DIR, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(args):
+    work_dir = tempfile.mkdtemp(prefix='stream-bench-')
+    media_dir = args.media_dir or os.path.join(work_dir, 'media')
+    results = {
+        'meta': {
+            'started_at': time.time(),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'ffmpeg': ffmpeg_version(),
+            'server': args.server,
+            'clients': args.clients,
+            'duration': args.duration,
+            'env': args.env,
+        },
+    }
+    media_server = app_process = watcher = None
+    try:
+        started = time.time()
+        generate_media(media_dir)
+        results['meta']['media_seconds'] = round(time.time() - started, 2)
+
+        media_server = start_media_server(media_dir, args.slow_rate)
+        media_url = f'http://127.0.0.1:{media_server.server_address[1]}'
+        port = free_port()
+        base_url = f'http://127.0.0.1:{port}'
+        env = dict(item.split('=', 1) for item in args.env)
+        env['DEFAULT_VIDEO_URL'] = media_url + '/default.mp4'
+
+        started = time.time()
+        app_process = start_app(work_dir, port, args.server, env)
+        watcher = PlaylistWatcher(base_url, args.poll_interval)
+        watcher.thread.start()
+        if not wait_for(lambda: watcher.order, 120):
+            raise RuntimeError(f'no segment published; see {work_dir}/app.log')
+        results['startup'] = {'seconds_to_first_segment': round(time.time() - started, 3)}
+
+        results['cpu'] = measure_cpu(app_process.pid, args.cpu_seconds)
+        results['download'] = measure_download(base_url, media_url + '/big.mp4')
+        results['download_resume'] = measure_download(base_url, media_url + '/flaky/big.mp4')
+        results['control_latency'] = measure_control_latency(base_url, media_url, args.control_samples)
+
+        for name in ('clip_a.mp4', 'clip_b.mp4'):
+            http_get(base_url, '/add?' + urllib.parse.urlencode({'link': f'{media_url}/{name}'}))
+        results['hls_load'] = asyncio.run(run_hls_clients('127.0.0.1', port, args.clients, args.duration))
+
+        # Let the queued items play out so every transition gets measured.
+        wait_for(lambda: queue_length(base_url) == 0, args.drain_timeout, interval=1)
+        time.sleep(args.poll_interval * 2 + 4)
+        watcher.stop_event.set()
+        results['transitions'] = watcher.results()
+
+        if args.lag_items:
+            lead = float(env.get('PRESPAWN_LEAD_SECONDS', 8))
+            bound = lead + 2 * float(env.get('HLS_TIME', 4))
+            results['transition_lag'] = measure_transition_lag(base_url, media_url, args.lag_items, bound,
+                                                               args.lag_items * MEDIA['long.mp4'][0] + args.drain_timeout)
+        metrics = http_get(base_url, '/metrics')
+        if metrics[0] == 200:
+            results['metrics'] = {line.split()[0]: float(line.split()[1]) for line in metrics[1].decode().splitlines()
+                                  if line and not line.startswith('#') and 'bucket' not in line}
+    finally:
+        if watcher:
+            watcher.stop_event.set()
+        if app_process:
+            app_process.send_signal(signal.SIGTERM)
+            try:
+                app_process.wait(timeout=40)
+            except subprocess.TimeoutExpired:
+                app_process.kill()
+        if media_server:
+            media_server.shutdown()
+        if args.keep:
+            print(f'work dir kept: {work_dir}', file=sys.stderr)
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    results['meta']['finished_at'] = time.time()
+    return results
+
+
+def flatten(value, prefix=''):
+    if isinstance(value, dict):
+        items = {}
+        for key, child in value.items():
+            items.update(flatten(child, f'{prefix}.{key}' if prefix else key))
+        return items
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return {prefix: value}
+    return {}
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = flatten({key: value for key, value in json.load(f).items() if key != 'meta'})
+    with open(new_path) as f:
+        new = flatten({key: value for key, value in json.load(f).items() if key != 'meta'})
+    for key in sorted(set(old) & set(new)):
+        change = f'{(new[key] - old[key]) / old[key] * 100:+.1f}%' if old[key] else ''
+        print(f'{key:60} {old[key]:>14} {new[key]:>14} {change:>9}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark for the HLS streaming app.')
+    parser.add_argument('--clients', type=int, default=200, help='simulated HLS players')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of player load')
+    parser.add_argument('--server', choices=['gunicorn', 'flask'], default='gunicorn')
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--media-dir', help='reuse generated media from this directory')
+    parser.add_argument('--slow-rate', type=int, default=2 * 1024 * 1024, help='bytes/s for the throttled download')
+    parser.add_argument('--control-samples', type=int, default=50)
+    parser.add_argument('--cpu-seconds', type=float, default=5)
+    parser.add_argument('--poll-interval', type=float, default=0.1)
+    parser.add_argument('--drain-timeout', type=float, default=120)
+    parser.add_argument('--lag-items', type=int, default=4, help='back-to-back items for the transition lag check (0 skips it)')
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE', help='extra app environment')
+    parser.add_argument('--keep', action='store_true', help='keep the scratch directory')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='print the change between two result files')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.server == 'gunicorn' and importlib.util.find_spec('gunicorn') is None:
+        args.server = 'flask'
+    results = run(args)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps({key: results[key] for key in results if key not in ('meta', 'metrics')}, indent=2))
+    if not results.get('transition_lag', {}).get('bounded', True):
+        sys.exit('publishing fell further behind ffmpeg with every transition')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+# Production entry point: gunicorn -c gunicorn.conf.py app:app
+#
+# Every channel's pipelines, segment stores and queue journals live in one
+# process, so this runs a single worker and scales HTTP with threads instead.
+# The gthread worker parks idle keep-alive connections in a selector; a thread
+# is only busy while a response is being written, and published .ts segments
+# go out with sendfile(). Target: a few thousand concurrent HLS clients per
+# node with the defaults below (each client asks for one playlist and one
+# segment per HLS_TIME seconds). Open /events streams and LL-HLS blocking
+# reloads hold a thread for as long as they last, so raise WEB_THREADS with the
+# number of dashboards watching. Past one node, put a caching proxy or CDN in
+# front: segment URLs are immutable and playlists are cacheable for
+# PLAYLIST_MAX_AGE seconds.
+import os
+import signal
+import sys
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+# More workers would each start their own copy of every stream; the app
+# refuses to boot a second supervisor anyway.
+workers = 1
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', '64'))
+worker_connections = int(os.environ.get('WEB_CONNECTIONS', '4000'))
+# Longer than a segment, so players keep their connection between requests.
+keepalive = int(os.environ.get('WEB_KEEPALIVE', '15'))
+timeout = 60
+# Enough for every channel's ffmpeg to get SIGTERM and finish its output.
+graceful_timeout = int(os.environ.get('WEB_GRACEFUL_TIMEOUT', '30'))
+# Recycling the worker would restart every stream.
+max_requests = 0
+# Threads do not survive fork, so the app is loaded in the worker.
+preload_app = False
+sendfile = True
+
+
+def post_worker_init(worker):
+    import app as stream_app
+    stream_app.start_services()
+    gunicorn_handler = signal.getsignal(signal.SIGTERM)
+
+    def handle_term(sig, frame):
+        stream_app.begin_shutdown()
+        gunicorn_handler(sig, frame)
+
+    signal.signal(signal.SIGTERM, handle_term)
+
+
+def worker_exit(server, worker):
+    stream_app = sys.modules.get('app')
+    if stream_app is not None:
+        stream_app.stop_services()